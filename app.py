@@ -1,14 +1,27 @@
 # app.py
 import os
 import logging
-from flask import Flask, render_template, request, jsonify, session, g, after_this_request
+from flask import Flask, render_template, request, jsonify, session, g, after_this_request, send_file
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from flask_cors import CORS
-from utils import encode_image, generate_design_review
+from werkzeug.middleware.proxy_fix import ProxyFix
+from utils import (
+    encode_image, generate_design_review, generate_revision_review, normalize_image, warm_up_openai, model_router
+)
+from image_diff import find_changed_regions, crop_regions
 from buymeacoffee import BuyMeACoffeeAPI
+from review_store import ReviewStore
+from pdf_export import PDFExporter
+from resilience import Deadline, breaker_snapshots
+from upload_store import UploadStore
+from quota import QuotaEngine
 from dotenv import load_dotenv
 import base64
+import hashlib
+import hmac
+import threading
+import time
 
 
 # Load environment variables
@@ -24,6 +37,13 @@ logger = logging.getLogger(__name__)
 app = Flask(__name__)
 app.secret_key = os.environ.get('FLASK_SECRET_KEY')
 
+# Behind a reverse proxy, set TRUSTED_PROXY_COUNT to the number of proxies in front
+# of the app so the client address comes from X-Forwarded-For. Left at 0 the header
+# is ignored, since clients could forge it.
+TRUSTED_PROXY_COUNT = int(os.environ.get('TRUSTED_PROXY_COUNT', 0))
+if TRUSTED_PROXY_COUNT:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_COUNT, x_proto=TRUSTED_PROXY_COUNT)
+
 # Secure session cookies
 app.config.update(
     SESSION_COOKIE_SECURE=True,
@@ -34,6 +54,16 @@ app.config.update(
 # Initialize Buy Me a Coffee API
 bmac_api = BuyMeACoffeeAPI()
 
+# Stored reviews and their background PDF renders
+review_store = ReviewStore()
+pdf_exporter = PDFExporter()
+
+# Images uploaded ahead of /analyze, referenced by signed token
+upload_store = UploadStore(app.secret_key)
+
+# Daily review quota, charged only for successful, uncached reviews
+quota_engine = QuotaEngine()
+
 # Configure CORS
 CORS(app, resources={
     r"/*": {
@@ -77,44 +107,128 @@ def set_security_headers(response):
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
 MAX_FILE_SIZE = 5 * 1024 * 1024  # 5MB
 
+# Total time an /analyze request may spend, upstream calls included
+REQUEST_BUDGET_SECONDS = float(os.environ.get('REQUEST_BUDGET_SECONDS', 120))
+
+# Identical image, context and tier within this window is served from the review cache
+REVIEW_CACHE_TTL = int(os.environ.get('REVIEW_CACHE_TTL', 24 * 60 * 60))
+
+# Bearer token for /metrics/upstreams; without it the route only answers on loopback
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+# Session emails are unverified, so every review is also charged to the client
+# address. This is an abuse backstop, not an allowance: it has to cover everyone
+# behind a shared NAT or office network.
+QUOTA_IP_LIMIT = int(os.environ.get('QUOTA_IP_LIMIT', 200))
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-# Initialize Limiter with no default limits
+# Initialize Limiter with no default limits. Point RATELIMIT_STORAGE_URI at a
+# shared backend (e.g. redis://) when running more than one worker process.
 limiter = Limiter(
     app=app,
     key_func=get_remote_address,
-    default_limits=[]
+    default_limits=[],
+    storage_uri=os.environ.get('RATELIMIT_STORAGE_URI', 'memory://')
 )
 
-def is_supporter():
-    """Helper function to determine if current session user is a supporter"""
+# Set once this process has warmed its upstream connections
+worker_ready = threading.Event()
+
+def start_background_tasks():
+    """
+    Start background work in this process, after any fork.
+
+    Called in every gunicorn worker; the reconciliation loop elects one of them
+    to do the work.
+    """
+    bmac_api.start_reconciliation()
+
+# Seconds between OpenAI warm-up attempts while a worker is not ready, doubling up to a minute
+WARM_UP_RETRY_INTERVAL = float(os.environ.get('WARM_UP_RETRY_INTERVAL', 2))
+
+def warm_up():
+    """
+    Prepare a worker to serve traffic.
+
+    Templates are compiled here and, with preload_app, in the master too so they
+    are shared copy-on-write. The OpenAI connection is opened per worker since
+    sockets must not be shared across a fork; the worker reports ready once it
+    has succeeded, retrying in the background until then. Supporter status is
+    read from the local store, so no Buy Me a Coffee connection is needed.
+    """
+    # Replace any session (and its pool locks) inherited from the master
+    bmac_api.reset_session()
+    app.jinja_env.get_template('index.html')
+
+    if warm_up_openai():
+        worker_ready.set()
+        logger.info(f"Worker {os.getpid()} warmed up and ready")
+        return
+
+    def retry():
+        interval = WARM_UP_RETRY_INTERVAL
+        while True:
+            time.sleep(interval)
+            if warm_up_openai():
+                worker_ready.set()
+                logger.info(f"Worker {os.getpid()} warmed up and ready")
+                return
+            interval = min(interval * 2, 60)
+
+    threading.Thread(target=retry, name='warm-up', daemon=True).start()
+
+def get_quota_limit(is_supporter_flag):
+    """Determine daily review quota based on supporter status"""
+    return 15 if is_supporter_flag else 5
+
+def quota_limits(is_supporter_flag):
+    """
+    Quota keys a review is charged to, with their daily limits.
+
+    The user's own allowance is keyed by session email, or by client address
+    for anonymous users. Every review also counts towards the per-address
+    backstop, so rotating emails from one address only goes so far.
+    """
+    address = get_remote_address()
     email = session.get('email', '')
-    supporter_status = bmac_api.get_supporter_status(email)
-    return supporter_status.get('is_supporter', False)
+    user_identity = f"email:{email.lower()}" if email else f"anon:{address}"
+    return {
+        user_identity: get_quota_limit(is_supporter_flag),
+        f"ip:{address}": QUOTA_IP_LIMIT
+    }
+
+def rate_info_from_quota(quota_status):
+    return {
+        'requests_used': quota_status['used'],
+        'requests_limit': quota_status['limit'],
+        'requests_remaining': quota_status['remaining']
+    }
 
-def get_rate_limit():
-    """Determine rate limit based on supporter status"""
-    return "15 per day" if is_supporter() else "5 per day"
+def set_quota_headers(response, quota_status):
+    response.headers['X-RateLimit-Limit'] = str(quota_status['limit'])
+    response.headers['X-RateLimit-Remaining'] = str(quota_status['remaining'])
+    response.headers['X-RateLimit-Reset'] = str(quota_status['reset'])
+    return response
 
 @app.route('/')
 def index():
     email = session.get('email', '')
     is_supporter_flag = False
-    rate_info = {
-        'requests_used': 0,
-        'requests_limit': 5
-    }
 
     buymeacoffee_url = bmac_api.get_support_url()
 
     if email:
         supporter_status = bmac_api.get_supporter_status(email)
         is_supporter_flag = supporter_status.get('is_supporter', False)
-        rate_info['requests_limit'] = 15 if is_supporter_flag else 5
     else:
         supporter_status = None
 
+    rate_info = rate_info_from_quota(
+        quota_engine.status(quota_limits(is_supporter_flag))
+    )
+
     return render_template(
         'index.html',
         rate_info=rate_info,
@@ -142,10 +256,9 @@ def set_email():
         supporter_status = bmac_api.get_supporter_status(email)
         is_supporter_flag = supporter_status.get('is_supporter', False)
 
-        rate_info = {
-            'requests_used': 0,  # Implement actual tracking if needed
-            'requests_limit': 15 if is_supporter_flag else 5
-        }
+        rate_info = rate_info_from_quota(
+            quota_engine.status(quota_limits(is_supporter_flag))
+        )
 
         return jsonify({
             'message': 'Email set successfully',
@@ -157,38 +270,147 @@ def set_email():
         logger.error(f"Error in set_email: {str(e)}")
         return jsonify({'error': 'An error occurred', 'message': str(e)}), 500
 
-@app.route('/analyze', methods=['POST'])
-@limiter.limit(get_rate_limit)
-def analyze_design():
+@app.route('/webhooks/buymeacoffee', methods=['POST'])
+@limiter.exempt
+def buymeacoffee_webhook():
+    payload = request.get_data()
+    signature = request.headers.get('X-Signature-Sha256', '')
+
+    if not bmac_api.verify_webhook_signature(payload, signature):
+        logger.warning("Rejected Buy Me a Coffee webhook with invalid signature")
+        return jsonify({'error': 'Invalid signature'}), 401
+
+    event = request.get_json(silent=True)
+    if not isinstance(event, dict):
+        return jsonify({'error': 'Invalid payload'}), 400
+
     try:
-        logger.debug("Starting design analysis")
+        applied = bmac_api.handle_webhook_event(event)
+        logger.info(f"Processed webhook {event.get('type')} (applied: {applied})")
+        return jsonify({'received': True, 'applied': applied}), 200
+    except Exception as e:
+        logger.error(f"Error processing webhook: {str(e)}")
+        return jsonify({'error': 'Failed to process webhook'}), 500
+
+def read_uploaded_image():
+    """
+    Read, validate and normalize the image in the current request.
+
+    Returns:
+        tuple: (normalized image bytes, None) or (None, error response).
+    """
+    if 'image' not in request.files:
+        logger.error("No file part in request")
+        return None, (jsonify({'error': 'No file provided'}), 400)
+
+    file = request.files['image']
+    if file.filename == '':
+        logger.error("No selected file")
+        return None, (jsonify({'error': 'No file selected'}), 400)
+
+    if not allowed_file(file.filename):
+        logger.error(f"Invalid file type: {file.filename}")
+        return None, (jsonify({
+            'error': 'Invalid file type. Supported formats: PNG, JPG, JPEG'
+        }), 400)
+
+    # Read and validate file
+    try:
+        image_data = file.read()
+        logger.debug(f"Successfully read image data, size: {len(image_data)} bytes")
+    except Exception as e:
+        logger.error(f"Error reading file: {str(e)}")
+        return None, (jsonify({'error': 'Error reading uploaded file'}), 400)
 
-        if 'image' not in request.files:
-            logger.error("No file part in request")
-            return jsonify({'error': 'No file provided'}), 400
+    if len(image_data) > MAX_FILE_SIZE:
+        logger.error(f"File too large: {len(image_data)} bytes")
+        return None, (jsonify({'error': 'File size exceeds 5MB limit'}), 400)
 
-        file = request.files['image']
-        if file.filename == '':
-            logger.error("No selected file")
-            return jsonify({'error': 'No file selected'}), 400
+    try:
+        image_data, _ = normalize_image(image_data)
+    except ValueError as e:
+        logger.error(f"Invalid image: {str(e)}")
+        return None, (jsonify({
+            'error': 'Invalid image file. Supported formats: PNG, JPG, JPEG',
+            'message': str(e)
+        }), 400)
 
-        if not allowed_file(file.filename):
-            logger.error(f"Invalid file type: {file.filename}")
-            return jsonify({
-                'error': 'Invalid file type. Supported formats: PNG, JPG, JPEG'
-            }), 400
+    return image_data, None
 
-        # Read and validate file
-        try:
-            image_data = file.read()
-            logger.debug(f"Successfully read image data, size: {len(image_data)} bytes")
-        except Exception as e:
-            logger.error(f"Error reading file: {str(e)}")
-            return jsonify({'error': 'Error reading uploaded file'}), 400
+@app.route('/uploads', methods=['POST'])
+@limiter.limit("60 per hour")
+def upload_image():
+    try:
+        image_data, error_response = read_uploaded_image()
+        if error_response:
+            return error_response
 
-        if len(image_data) > MAX_FILE_SIZE:
-            logger.error(f"File too large: {len(image_data)} bytes")
-            return jsonify({'error': 'File size exceeds 5MB limit'}), 400
+        upload = upload_store.put(image_data)
+        logger.debug(f"Stored upload {upload['sha256']}")
+        return jsonify(upload), 201
+
+    except Exception as e:
+        logger.error(f"Unexpected error in upload_image: {str(e)}")
+        return jsonify({
+            'error': 'An unexpected error occurred',
+            'message': str(e)
+        }), 500
+
+def review_revision(previous_review, image_data, context, is_supporter_flag, deadline):
+    """
+    Review only what changed since a previous review of the same design.
+
+    Returns:
+        dict: Delta review, or None when the images cannot be compared region by
+            region and a full review is needed instead.
+    """
+    previous_image = review_store.load_image(previous_review['image_hash'])
+    if previous_image is None:
+        logger.debug("Previous image not available, falling back to full review")
+        return None
+
+    diff = find_changed_regions(previous_image, image_data)
+    if diff is None:
+        return None
+
+    if not diff['regions']:
+        return {
+            'review_content': '# Overview of Changes\nNo visual changes were detected since the previous review.',
+            'is_premium': is_supporter_flag,
+            'model': None,
+            'status': 'success'
+        }
+
+    logger.debug(f"Revision changed {diff['changed_fraction']:.0%} of the design in {len(diff['regions'])} regions")
+    return generate_revision_review(
+        crop_regions(previous_image, diff['regions'], size=diff['size']),
+        crop_regions(image_data, diff['regions']),
+        diff['regions'],
+        diff['size'],
+        previous_review['review_content'],
+        context or 'No context provided',
+        is_supporter=is_supporter_flag,
+        deadline=deadline
+    )
+
+@app.route('/analyze', methods=['POST'])
+def analyze_design():
+    deadline = Deadline(REQUEST_BUDGET_SECONDS)
+    try:
+        logger.debug("Starting design analysis")
+
+        upload_token = request.form.get('upload_token', '').strip()
+        if upload_token:
+            # Image was uploaded and normalized ahead of time
+            image_data, image_hash = upload_store.get(upload_token)
+            if image_data is None:
+                logger.error("Unknown or expired upload token")
+                return jsonify({'error': 'Upload expired. Please select the image again.'}), 410
+        else:
+            image_data, error_response = read_uploaded_image()
+            if error_response:
+                return error_response
+            image_hash = hashlib.sha256(image_data).hexdigest()
 
         context = request.form.get('context', '').strip()
         if len(context) > 500:
@@ -197,6 +419,15 @@ def analyze_design():
 
         logger.debug(f"Processing with context: {context[:100]}...")
 
+        # Revision mode: review only the regions changed since a previous review
+        previous_review_id = request.form.get('previous_review_id', '').strip()
+        previous_review = None
+        if previous_review_id:
+            previous_review = review_store.get(previous_review_id)
+            if not previous_review:
+                logger.error(f"Previous review not found: {previous_review_id}")
+                return jsonify({'error': 'Previous review not found'}), 404
+
         # Get user status and generate review
         email = session.get('email', '')
         is_supporter_flag = False
@@ -207,28 +438,101 @@ def analyze_design():
         else:
             supporter_status = None
 
+        limits = quota_limits(is_supporter_flag)
+        tier = 'supporter' if is_supporter_flag else 'free'
+        cache_key = hashlib.sha256(
+            f"{image_hash}\0{tier}\0{context}\0{previous_review_id}".encode('utf-8')
+        ).hexdigest()
+
+        # Cache hits cost nothing, so they are served without touching the quota
+        cached_review = review_store.find_cached(cache_key, REVIEW_CACHE_TTL)
+        if cached_review:
+            logger.debug(f"Serving cached review {cached_review['id']}")
+            quota_status = quota_engine.status(limits)
+            response = jsonify({
+                'review': {
+                    'review_content': cached_review['review_content'],
+                    'is_premium': cached_review['is_premium'],
+                    'model': cached_review['model'],
+                    'review_id': cached_review['id'],
+                    'mode': 'revision' if cached_review['previous_review_id'] else 'full',
+                    'previous_review_id': cached_review['previous_review_id'],
+                    'cached': True,
+                    'status': 'success'
+                },
+                'rate_info': rate_info_from_quota(quota_status)
+            })
+            return set_quota_headers(response, quota_status)
+
+        # Reserve a unit now; it is committed only if a new review is generated
+        reservation_id, quota_status = quota_engine.reserve(limits)
+        if reservation_id is None:
+            logger.info(f"Daily review quota exhausted for {quota_status['identity']}")
+            if quota_status['identity'].startswith('ip:'):
+                message = 'Too many reviews have come from your network today. Please try again tomorrow.'
+            else:
+                message = f"You have used all {quota_status['limit']} reviews for today. Please try again tomorrow."
+            response = jsonify({
+                'error': 'Daily review limit reached',
+                'message': message,
+                'rate_info': rate_info_from_quota(quota_status)
+            })
+            response.status_code = 429
+            response.headers['Retry-After'] = str(max(0, quota_status['reset'] - int(time.time())))
+            return set_quota_headers(response, quota_status)
+
+        settled = False
         try:
-            base64_image = encode_image(image_data)
-            review_response = generate_design_review(
-                base64_image,
-                context or 'No context provided',
-                is_supporter=is_supporter_flag
-            )
-
-            logger.debug("Successfully generated review")
-
-            rate_info = {
-                'requests_used': 0,  # Implement actual tracking if needed
-                'requests_limit': 15 if is_supporter_flag else 5
-            }
-
-            return jsonify({
+            review_response = None
+            if previous_review:
+                review_response = review_revision(
+                    previous_review, image_data, context, is_supporter_flag, deadline
+                )
+
+            if review_response is None:
+                base64_image = encode_image(image_data)
+                review_response = generate_design_review(
+                    base64_image,
+                    context or 'No context provided',
+                    is_supporter=is_supporter_flag,
+                    deadline=deadline
+                )
+                review_response['mode'] = 'full'
+            else:
+                review_response['mode'] = 'revision'
+                review_response['previous_review_id'] = previous_review_id
+
+            if review_response.get('status') == 'success':
+                logger.debug("Successfully generated review")
+                # Keep the image so this review can be the base of the next revision
+                review_store.save_image(image_hash, image_data)
+                review_response['review_id'] = review_store.save(
+                    review_response,
+                    context,
+                    cache_key=cache_key,
+                    image_hash=image_hash,
+                    previous_review_id=previous_review_id if review_response['mode'] == 'revision' else None
+                )
+                # A revision with no visual changes is answered without a model call
+                if review_response.get('model'):
+                    quota_status = quota_engine.commit(reservation_id, limits) or quota_status
+                    settled = True
+
+            if not settled:
+                # Upstream failures and reviews that cost nothing do not count against the quota
+                quota_status = quota_engine.refund(reservation_id, limits) or quota_status
+                settled = True
+
+            response = jsonify({
                 'review': review_response,
-                'rate_info': rate_info
-            }), 200
+                'rate_info': rate_info_from_quota(quota_status)
+            })
+            return set_quota_headers(response, quota_status)
 
         except Exception as e:
             logger.error(f"Error generating review: {str(e)}")
+            if not settled:
+                quota_engine.refund(reservation_id, limits)
             return jsonify({
                 'error': 'Failed to generate review',
                 'message': str(e)
@@ -241,7 +545,101 @@ def analyze_design():
             'message': str(e)
         }), 500
 
+@app.route('/healthz')
+@limiter.exempt
+def healthz():
+    """Liveness: the process is up and serving requests"""
+    return jsonify({'status': 'ok'}), 200
+
+@app.route('/readyz')
+@limiter.exempt
+def readyz():
+    """Readiness: OpenAI warm-up succeeded and local stores reachable"""
+    checks = {'warmed_up': worker_ready.is_set()}
+
+    try:
+        review_store.get('readyz')
+        bmac_api.store.get_state('last_reconciled_at')
+        checks['stores'] = True
+    except Exception as e:
+        logger.error(f"Readiness check failed: {str(e)}")
+        checks['stores'] = False
+
+    ready = all(checks.values())
+    # Open circuits are reported but do not fail readiness; every worker shares the same upstreams
+    upstreams = {name: snapshot['state'] for name, snapshot in breaker_snapshots().items()}
+    return jsonify({
+        'status': 'ready' if ready else 'not ready',
+        'checks': checks,
+        'upstreams': upstreams
+    }), 200 if ready else 503
+
+def metrics_authorized():
+    """
+    Whether the current request may read internal metrics.
+
+    With METRICS_TOKEN set, a matching bearer token is required. Otherwise only
+    direct loopback requests are allowed; anything relayed by a proxy carries
+    X-Forwarded-For and is refused.
+    """
+    if METRICS_TOKEN:
+        supplied = request.headers.get('Authorization', '')
+        return hmac.compare_digest(supplied.encode('utf-8'), f'Bearer {METRICS_TOKEN}'.encode('utf-8'))
+    return request.remote_addr in ('127.0.0.1', '::1') and 'X-Forwarded-For' not in request.headers
+
+@app.route('/metrics/upstreams')
+@limiter.exempt
+def upstream_metrics():
+    """Circuit breaker states, timeout counts and recent transitions per upstream, plus per-model routing stats"""
+    if not metrics_authorized():
+        return jsonify({'error': 'Forbidden'}), 403
+    return jsonify({
+        'upstreams': breaker_snapshots(),
+        'models': model_router.snapshot()
+    }), 200
+
+@app.route('/reviews/<review_id>/export.pdf')
+def export_review_pdf(review_id):
+    review = review_store.get(review_id)
+    if not review:
+        return jsonify({'error': 'Review not found'}), 404
+
+    # Gated on the review rather than the viewer so shared links keep working
+    if not review['is_premium']:
+        return jsonify({'error': 'PDF export is available for premium reviews only'}), 403
+
+    try:
+        status, path, digest = pdf_exporter.get_or_schedule(review)
+    except Exception as e:
+        logger.error(f"Error scheduling PDF export: {str(e)}")
+        return jsonify({'error': 'Failed to export review', 'message': str(e)}), 500
+
+    if status == 'failed':
+        return jsonify({'error': 'Failed to export review', 'message': 'Rendering failed, please try again'}), 500
+
+    if status == 'rendering':
+        response = jsonify({'status': 'rendering'})
+        response.status_code = 202
+        response.headers['Retry-After'] = '2'
+        return response
+
+    # conditional=True handles Range, If-Range and If-None-Match for repeat downloads
+    response = send_file(
+        path,
+        mimetype='application/pdf',
+        as_attachment=True,
+        download_name=f'design-review-{review_id}.pdf',
+        conditional=True,
+        etag=digest,
+        max_age=24 * 60 * 60
+    )
+    response.headers['Accept-Ranges'] = 'bytes'
+    return response
+
 if __name__ == '__main__':
+    # Development server; use `gunicorn -c gunicorn.conf.py app:app` in production
+    start_background_tasks()
+    warm_up()
     app.run(
         host='0.0.0.0',
         port=5001,
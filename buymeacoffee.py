@@ -1,18 +1,76 @@
 # buymeacoffee.py
 import os
+import fcntl
+import hashlib
+import hmac
+import json
+import threading
+import time
 import requests
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
 import logging
 from dotenv import load_dotenv
+from supporter_store import SupporterStore
+from resilience import Deadline, get_breaker, hedged_call, CircuitOpenError
 
 load_dotenv()
 logger = logging.getLogger(__name__)
 
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+SUBSCRIPTION_GRACE_DAYS = 30
+
+def to_timestamp(value):
+    """Convert a Buy Me a Coffee date (unix seconds or 'YYYY-MM-DD HH:MM:SS' UTC) to a timestamp"""
+    if value in (None, ''):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str) and value.isdigit():
+        return float(value)
+    return datetime.strptime(value, DATE_FORMAT).replace(tzinfo=timezone.utc).timestamp()
+
+def format_timestamp(timestamp):
+    """Format a unix timestamp the way the Buy Me a Coffee API formats dates"""
+    if timestamp is None:
+        return None
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime(DATE_FORMAT)
+
+def is_refunded(supporter):
+    """Whether an API supporter entry has been refunded"""
+    return str(supporter.get('is_refunded') or '').lower() in ('1', 'true')
+
+def webhook_event_key(event):
+    """Key identifying a webhook event across redeliveries"""
+    event_type = event.get('type', '')
+    if event.get('event_id') is not None:
+        return f"{event_type}:event:{event['event_id']}"
+    # Without an id, a redelivery is recognised by carrying the same data
+    body = json.dumps(event.get('data') or {}, sort_keys=True, separators=(',', ':'))
+    return f"{event_type}:sha256:{hashlib.sha256(body.encode()).hexdigest()}"
+
 class BuyMeACoffeeAPI:
     def __init__(self):
         self.token = os.environ.get('BUYMEACOFFEE_TOKEN')
         self.base_url = 'https://developers.buymeacoffee.com/api/v1'
         self.headers = {'Authorization': f'Bearer {self.token}'}
+        # Pooled connections for request handling; each worker replaces it after fork
+        self.session = self.new_session()
+        self.webhook_secret = os.environ.get('BUYMEACOFFEE_WEBHOOK_SECRET')
+        # How long applied webhook events are remembered to ignore redeliveries
+        self.webhook_dedupe_window = int(os.environ.get('BUYMEACOFFEE_WEBHOOK_DEDUPE_WINDOW', 3 * 24 * 60 * 60))
+        self.reconcile_interval = int(os.environ.get('BUYMEACOFFEE_RECONCILE_INTERVAL', 6 * 60 * 60))
+        self.reconcile_budget = float(os.environ.get('BUYMEACOFFEE_RECONCILE_BUDGET', 60))
+        # Guard against a pagination loop; a full list longer than this fails the pass
+        self.max_pages = int(os.environ.get('BUYMEACOFFEE_MAX_PAGES', 200))
+        self.store = SupporterStore()
+        self._reconcile_thread = None
+
+        # Upstream timeouts and optional request hedging. Requests never call the
+        # API (supporter status is read from the store), so hedging only shortens
+        # reconciliation passes, at the cost of duplicate page fetches; off by default.
+        self.timeout = float(os.environ.get('BUYMEACOFFEE_TIMEOUT', 10))
+        self.hedge_after = float(os.environ.get('BUYMEACOFFEE_HEDGE_AFTER', 0))
+        self.breaker = get_breaker('buymeacoffee')
         
         # Test emails configuration
         self.test_emails = {
@@ -28,6 +86,16 @@ class BuyMeACoffeeAPI:
             ]
         }
 
+    def new_session(self):
+        """Create a pooled, authenticated session"""
+        session = requests.Session()
+        session.headers.update(self.headers)
+        return session
+
+    def reset_session(self):
+        """Drop pooled connections inherited across a fork"""
+        self.session = self.new_session()
+
     def is_test_email(self, email):
         """Check if email is a test email and return its tier"""
         email_lower = email.lower()
@@ -38,34 +106,311 @@ class BuyMeACoffeeAPI:
             return 'free'
         return None
 
-    def get_supporters(self):
+    def get_supporters(self, raise_errors=False, deadline=None, session=None):
         """Fetch all supporters (both subscriptions and one-time supporters)"""
         supporters = []
         try:
             # Fetch recurring supporters (subscriptions)
-            subscriptions = self.fetch_supporters('subscriptions', params={'status': 'active'})
+            subscriptions = self.fetch_supporters('subscriptions', params={'status': 'active'}, raise_errors=raise_errors, deadline=deadline, session=session)
             supporters.extend(subscriptions)
             
             # Fetch one-time supporters
-            one_time_supporters = self.fetch_supporters('supporters')
+            one_time_supporters = self.fetch_supporters('supporters', raise_errors=raise_errors, deadline=deadline, session=session)
             supporters.extend(one_time_supporters)
             
         except Exception as e:
             logger.error(f"Error fetching supporters: {e}")
+            if raise_errors:
+                raise
         
         return supporters
 
-    def fetch_supporters(self, endpoint, params=None):
-        """Helper function to fetch supporters data from a given endpoint"""
-        url = f"{self.base_url}/{endpoint}"
+    def _get(self, url, params=None, timeout=None, session=None):
+        """GET an API URL through the circuit breaker"""
+        if not self.breaker.allow():
+            raise CircuitOpenError("Buy Me a Coffee API circuit is open")
+
         try:
-            response = requests.get(url, headers=self.headers, params=params)
+            response = (session or self.session).get(url, params=params, timeout=timeout or self.timeout)
+            if response.status_code >= 500 or response.status_code == 429:
+                self.breaker.record_failure()
+            elif response.ok:
+                self.breaker.record_success()
+            else:
+                self.breaker.release()
             response.raise_for_status()
-            data = response.json()
-            return data.get('data', [])
-        except requests.RequestException as e:
-            logger.error(f"API request failed for {endpoint}: {e}")
-            return []
+            return response.json()
+        except requests.Timeout:
+            self.breaker.record_failure(timeout=True)
+            raise
+        except requests.ConnectionError:
+            self.breaker.record_failure()
+            raise
+        except Exception:
+            # Anything else (bad encoding, redirects, invalid JSON) says nothing about
+            # upstream health, but must not leave a half-open probe unsettled
+            self.breaker.release()
+            raise
+
+    def fetch_supporters(self, endpoint, params=None, raise_errors=False, deadline=None, session=None):
+        """
+        Fetch every page of supporters data from a given endpoint.
+
+        Args:
+            endpoint (str): API endpoint, e.g. 'supporters'.
+            params (dict): Query parameters, sent with every page.
+            raise_errors (bool): Raise on failure instead of returning a partial list.
+            deadline (Deadline): Budget shared by all pages.
+            session (requests.Session): Session to fetch with; defaults to the request-handling one.
+
+        Returns:
+            list: Entries from all pages, or those fetched before a failure.
+        """
+        url = f"{self.base_url}/{endpoint}"
+        results = []
+        pages = 0
+        try:
+            while url:
+                if pages >= self.max_pages:
+                    raise requests.RequestException(f"{endpoint} has more than {self.max_pages} pages")
+                timeout = deadline.timeout(cap=self.timeout) if deadline else self.timeout
+
+                if self.hedge_after > 0:
+                    data = hedged_call(lambda page_url=url: self._get(page_url, params, timeout, session), self.hedge_after)
+                else:
+                    data = self._get(url, params, timeout, session)
+                results.extend(data.get('data', []))
+                pages += 1
+                # next_page_url only carries the page number, so filters are sent again
+                url = data.get('next_page_url')
+            return results
+        except (requests.RequestException, CircuitOpenError) as e:
+            logger.error(f"API request failed for {endpoint} page {pages + 1}: {e}")
+            if raise_errors:
+                raise
+            return results
+
+    def parse_supporter(self, supporter):
+        """
+        Convert a supporter entry from the API into a store record.
+
+        Returns:
+            dict: Keyword arguments for SupporterStore.upsert, or None if the entry
+                carries no premium entitlement.
+        """
+        supporter_email = supporter.get('payer_email') or supporter.get('support_email') or ''
+        if not supporter_email or is_refunded(supporter):
+            return None
+
+        if 'subscription_current_period_end' in supporter:
+            # Subscriptions stay premium for a grace period after the current period ends
+            end_timestamp = to_timestamp(supporter.get('subscription_current_period_end'))
+            if end_timestamp is None:
+                return None
+            total_support = float(supporter.get('subscription_coffee_price', 0)) * supporter.get('subscription_coffee_num', 1)
+            return {
+                'email': supporter_email,
+                'kind': 'subscription',
+                'last_support_date': supporter.get('subscription_updated_on'),
+                'total_support': total_support,
+                'expires_at': end_timestamp + timedelta(days=SUBSCRIPTION_GRACE_DAYS).total_seconds()
+            }
+
+        # One-time supporter
+        total_support = float(supporter.get('support_coffee_price', 0)) * supporter.get('support_coffees', 1)
+        return {
+            'email': supporter_email,
+            'kind': 'one_time',
+            'last_support_date': supporter.get('support_updated_on'),
+            'total_support': total_support,
+            'expires_at': None
+        }
+
+    def reconcile(self, session=None):
+        """
+        Rebuild the local supporter store from a full fetch to catch missed webhook events.
+
+        Args:
+            session (requests.Session): Session to fetch with, kept apart from request handling.
+
+        Returns:
+            bool: True if the pass completed.
+        """
+        started_at = time.time()
+        try:
+            # Any page failing raises, so unseen subscriptions are only expired after a complete fetch
+            supporters = self.get_supporters(
+                raise_errors=True, deadline=Deadline(self.reconcile_budget), session=session
+            )
+        except Exception as e:
+            logger.error(f"Supporter reconciliation skipped: {e}")
+            return False
+
+        seen = {'subscription': set(), 'one_time': set()}
+        refunded = set()
+        records = []
+        one_time = {}
+        for supporter in supporters:
+            if is_refunded(supporter):
+                email = supporter.get('payer_email') or supporter.get('support_email')
+                if email:
+                    refunded.add(email.lower())
+                continue
+            record = self.parse_supporter(supporter)
+            if not record:
+                continue
+            email = record['email'].lower()
+            seen[record['kind']].add(email)
+            if record['kind'] != 'one_time':
+                records.append(record)
+            elif email not in one_time:
+                one_time[email] = record
+            else:
+                # The store keeps one row per supporter, totalling every unrefunded support
+                merged = one_time[email]
+                merged['total_support'] += record['total_support']
+                merged['last_support_date'] = max(
+                    filter(None, (merged['last_support_date'], record['last_support_date'])), default=None
+                )
+
+        for record in records + list(one_time.values()):
+            # Reconciliation data is only as fresh as the fetch, so a webhook received
+            # during the pass still wins
+            self.store.upsert(source='reconcile', event_at=started_at, **record)
+
+        # Only subscriptions lapse; one-time support is permanent unless every support was refunded
+        expired = self.store.expire_unseen('subscription', seen['subscription'], before=started_at)
+        for email in refunded - seen['one_time']:
+            if self.store.expire(email, 'one_time', event_at=started_at):
+                expired += 1
+        # Claims only need to outlive the provider's redelivery attempts
+        self.store.prune_events(before=started_at - self.webhook_dedupe_window)
+        self.store.set_state('last_reconciled_at', started_at)
+        logger.info(
+            f"Supporter reconciliation complete: {len(supporters)} fetched, {expired} records expired"
+        )
+        return True
+
+    def start_reconciliation(self):
+        """
+        Start the low-frequency background reconciliation loop.
+
+        Safe to call in every worker process: an exclusive file lock elects a single
+        reconciler, and another worker takes over if that one exits.
+        """
+        if self._reconcile_thread and self._reconcile_thread.is_alive():
+            return
+
+        def run():
+            lock_file = open(f'{self.store.path}.reconcile.lock', 'a')
+            while True:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except OSError:
+                    time.sleep(60)
+
+            logger.info(f"Process {os.getpid()} is the supporter reconciler")
+            # Own session so reconciliation never shares sockets with request handling
+            session = self.new_session()
+            while True:
+                last_reconciled_at = float(self.store.get_state('last_reconciled_at', 0))
+                wait = last_reconciled_at + self.reconcile_interval - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+                    continue
+                try:
+                    self.reconcile(session=session)
+                except Exception as e:
+                    logger.error(f"Error during supporter reconciliation: {e}")
+                # Back off a full interval even on failure to avoid hammering the API
+                self.store.set_state('last_reconciled_at', time.time())
+
+        self._reconcile_thread = threading.Thread(target=run, name='bmac-reconcile', daemon=True)
+        self._reconcile_thread.start()
+
+    def verify_webhook_signature(self, payload, signature):
+        """Verify the HMAC-SHA256 signature Buy Me a Coffee sends with each webhook"""
+        if not self.webhook_secret or not signature:
+            return False
+        expected = hmac.new(self.webhook_secret.encode('utf-8'), payload, hashlib.sha256).hexdigest()
+        return hmac.compare_digest(expected, signature.strip().lower())
+
+    def handle_webhook_event(self, event):
+        """
+        Apply a webhook event to the local supporter store.
+
+        Each event is applied at most once; redeliveries of an event that was
+        already applied are ignored.
+
+        Args:
+            event (dict): Decoded webhook body with 'type', 'created' and 'data'.
+
+        Returns:
+            bool: True if the event changed the store.
+        """
+        event_key = webhook_event_key(event)
+        if not self.store.claim_event(event_key):
+            logger.info(f"Ignoring redelivered webhook event {event_key}")
+            return False
+
+        try:
+            return self._apply_webhook_event(event)
+        except Exception:
+            self.store.release_event(event_key)
+            raise
+
+    def _apply_webhook_event(self, event):
+        event_type = event.get('type', '')
+        data = event.get('data') or {}
+        email = data.get('supporter_email') or data.get('payer_email') or ''
+        if not email:
+            logger.debug(f"Ignoring webhook event without supporter email: {event_type}")
+            return False
+
+        event_at = to_timestamp(event.get('created')) or time.time()
+        support_date = format_timestamp(to_timestamp(data.get('created_at')) or event_at)
+
+        if event_type in ('donation.created', 'donation.refunded'):
+            amount = float(data.get('coffee_price') or data.get('amount') or 0) * int(data.get('coffee_count') or 1)
+
+        if event_type == 'donation.created':
+            return self.store.upsert(
+                email, 'one_time',
+                last_support_date=support_date,
+                total_support=amount,
+                event_at=event_at,
+                increment=True
+            )
+
+        if event_type == 'donation.refunded':
+            if not amount:
+                # Without an amount the next reconciliation settles what is left
+                logger.warning(f"Refund webhook without an amount for {email}")
+                return False
+            # Other donations from the same supporter keep premium
+            return self.store.refund(email, 'one_time', amount, event_at=event_at)
+
+        if event_type in ('membership.started', 'membership.updated'):
+            period_end = to_timestamp(data.get('current_period_end'))
+            if data.get('status') not in (None, 'active') or period_end is None:
+                return self.store.expire(email, 'subscription', event_at=event_at)
+            return self.store.upsert(
+                email, 'subscription',
+                last_support_date=support_date,
+                total_support=float(data.get('amount') or 0),
+                expires_at=period_end + timedelta(days=SUBSCRIPTION_GRACE_DAYS).total_seconds(),
+                event_at=event_at
+            )
+
+        if event_type == 'membership.cancelled':
+            # Keep access until the paid period ends
+            period_end = to_timestamp(data.get('current_period_end'))
+            expires_at = period_end if period_end and period_end > time.time() else None
+            return self.store.expire(email, 'subscription', expires_at=expires_at, event_at=event_at)
+
+        logger.debug(f"Ignoring unhandled webhook event type: {event_type}")
+        return False
 
     def get_supporter_status(self, email):
         """Check if an email belongs to a supporter"""
@@ -86,39 +431,10 @@ class BuyMeACoffeeAPI:
                     }
                 return {'is_supporter': False, 'tier': 'free'}
 
-            # Fetch all supporters
-            supporters = self.get_supporters()
-            logger.debug(f"Total supporters fetched: {len(supporters)}")
-            
-            # Search for the supporter by email
-            for supporter in supporters:
-                supporter_email = supporter.get('payer_email') or supporter.get('support_email') or ''
-                if supporter_email.lower() == email.lower():
-                    # Determine if subscription is active
-                    if 'subscription_current_period_end' in supporter:
-                        # Check if the subscription is still active (within 30 days)
-                        end_date_str = supporter.get('subscription_current_period_end')
-                        if end_date_str:
-                            end_date = datetime.strptime(end_date_str, '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
-                            now = datetime.now(timezone.utc)
-                            days_since_end = (now - end_date).days
-                            if days_since_end <= 30:
-                                total_support = float(supporter.get('subscription_coffee_price', 0)) * supporter.get('subscription_coffee_num', 1)
-                                return {
-                                    'is_supporter': True,
-                                    'tier': 'premium',
-                                    'last_support_date': supporter.get('subscription_updated_on'),
-                                    'total_support': total_support
-                                }
-                    else:
-                        # One-time supporter
-                        total_support = float(supporter.get('support_coffee_price', 0)) * supporter.get('support_coffees', 1)
-                        return {
-                            'is_supporter': True,
-                            'tier': 'premium',
-                            'last_support_date': supporter.get('support_updated_on'),
-                            'total_support': total_support
-                        }
+            # Look up the local store; webhooks and reconciliation keep it current
+            supporter_status = self.store.get_status(email)
+            if supporter_status:
+                return supporter_status
             
             logger.debug(f"No supporter found for email: {email}")
             return {'is_supporter': False, 'tier': 'free'}
@@ -0,0 +1,46 @@
+# gunicorn.conf.py
+#
+# Production entry point:
+#     gunicorn -c gunicorn.conf.py app:app
+import math
+import multiprocessing
+import os
+
+bind = os.environ.get('BIND', f"0.0.0.0:{os.environ.get('PORT', 5001)}")
+
+# Import the app once in the master so modules, configuration and compiled
+# templates are shared copy-on-write with every worker. The stores open a SQLite
+# connection per call and upstream connections are made per worker, so neither
+# is shared.
+preload_app = True
+
+# Reviews spend most of their time waiting on upstream calls, so each worker
+# runs threads; workers scale with CPUs for image normalization and PDF renders
+worker_class = 'gthread'
+workers = int(os.environ.get('WEB_WORKERS', multiprocessing.cpu_count()))
+upstream_concurrency = int(os.environ.get('UPSTREAM_CONCURRENCY', 32))
+threads = int(os.environ.get('WEB_THREADS', max(2, math.ceil(upstream_concurrency / workers))))
+
+# Leave room for a full request budget before a worker is considered stuck
+timeout = int(float(os.environ.get('REQUEST_BUDGET_SECONDS', 120))) + 30
+graceful_timeout = 30
+keepalive = 5
+
+accesslog = '-'
+errorlog = '-'
+loglevel = os.environ.get('LOG_LEVEL', 'info')
+
+def when_ready(server):
+    """Runs in the master before workers are forked"""
+    from app import app
+
+    # Compile templates once so workers inherit them. No threads or upstream
+    # connections are started here: they would not survive the fork.
+    app.jinja_env.get_template('index.html')
+
+def post_worker_init(worker):
+    """Runs in each worker before it accepts connections"""
+    from app import warm_up, start_background_tasks
+
+    warm_up()
+    start_background_tasks()
@@ -0,0 +1,163 @@
+# image_diff.py
+import io
+import os
+import logging
+from collections import deque
+from PIL import Image, ImageChops
+
+logger = logging.getLogger(__name__)
+
+# Width both images are scaled to before comparing
+ANALYSIS_WIDTH = 256
+# Grid cell size, in analysis pixels
+TILE_SIZE = 8
+# Per-pixel luminance difference that counts as a change (filters JPEG noise)
+PIXEL_THRESHOLD = 24
+# Share of changed pixels that marks a tile as changed
+TILE_THRESHOLD = 0.02
+# Padding around each region, as a share of the image width, so crops keep some context
+REGION_PADDING = 0.02
+
+# Above this share of changed area a full review is cheaper to reason about than crops
+MAX_CHANGED_FRACTION = float(os.environ.get('REVISION_MAX_CHANGED_FRACTION', 0.5))
+MAX_REGIONS = int(os.environ.get('REVISION_MAX_REGIONS', 6))
+
+def _load(image_data):
+    image = Image.open(io.BytesIO(image_data))
+    image.load()
+    return image
+
+def _changed_tiles(previous, current):
+    """Boolean grid of tiles whose content differs between the two images"""
+    height = max(1, round(current.height * ANALYSIS_WIDTH / current.width))
+    size = (ANALYSIS_WIDTH, height)
+
+    previous_small = previous.convert('L').resize(size, Image.BILINEAR)
+    current_small = current.convert('L').resize(size, Image.BILINEAR)
+    mask = ImageChops.difference(previous_small, current_small).point(
+        lambda value: 255 if value > PIXEL_THRESHOLD else 0
+    )
+
+    # Box-averaging the mask gives the share of changed pixels in each tile
+    grid_width = -(-size[0] // TILE_SIZE)
+    grid_height = -(-size[1] // TILE_SIZE)
+    tile_means = mask.resize((grid_width, grid_height), Image.BOX)
+    values = list(tile_means.getdata())
+
+    cutoff = 255 * TILE_THRESHOLD
+    return [
+        [values[y * grid_width + x] > cutoff for x in range(grid_width)]
+        for y in range(grid_height)
+    ]
+
+def _tile_boxes(grid):
+    """Bounding boxes, in tile coordinates, of 8-connected groups of changed tiles"""
+    grid_height, grid_width = len(grid), len(grid[0])
+    seen = [[False] * grid_width for _ in range(grid_height)]
+    boxes = []
+
+    for y in range(grid_height):
+        for x in range(grid_width):
+            if not grid[y][x] or seen[y][x]:
+                continue
+            left, top, right, bottom = x, y, x, y
+            queue = deque([(x, y)])
+            seen[y][x] = True
+            while queue:
+                cx, cy = queue.popleft()
+                left, top = min(left, cx), min(top, cy)
+                right, bottom = max(right, cx), max(bottom, cy)
+                for nx in range(cx - 1, cx + 2):
+                    for ny in range(cy - 1, cy + 2):
+                        if 0 <= nx < grid_width and 0 <= ny < grid_height and grid[ny][nx] and not seen[ny][nx]:
+                            seen[ny][nx] = True
+                            queue.append((nx, ny))
+            boxes.append((left, top, right + 1, bottom + 1))
+
+    return boxes
+
+def _area(box):
+    return (box[2] - box[0]) * (box[3] - box[1])
+
+def _union(boxes):
+    return (
+        min(box[0] for box in boxes),
+        min(box[1] for box in boxes),
+        max(box[2] for box in boxes),
+        max(box[3] for box in boxes)
+    )
+
+def find_changed_regions(previous_data, current_data):
+    """
+    Find the regions of a revised design that differ from the previous version.
+
+    Args:
+        previous_data (bytes): Normalized image the previous review was based on.
+        current_data (bytes): Normalized image of the revision.
+
+    Returns:
+        dict: 'regions' (list of (left, top, right, bottom) boxes in current image
+            pixels), 'changed_fraction' and 'size' of the current image, or None if
+            the images are too different to compare region by region.
+    """
+    previous = _load(previous_data)
+    current = _load(current_data)
+
+    # A different aspect ratio means a different layout, not an iteration
+    previous_ratio = previous.width / previous.height
+    current_ratio = current.width / current.height
+    if abs(previous_ratio - current_ratio) / current_ratio > 0.05:
+        logger.debug("Revision aspect ratio differs from previous image")
+        return None
+
+    grid = _changed_tiles(previous, current)
+    total_tiles = len(grid) * len(grid[0])
+    changed_tiles = sum(row.count(True) for row in grid)
+    changed_fraction = changed_tiles / total_tiles
+
+    if changed_fraction > MAX_CHANGED_FRACTION:
+        logger.debug(f"Revision changed {changed_fraction:.0%} of the design")
+        return None
+
+    boxes = sorted(_tile_boxes(grid), key=_area, reverse=True)
+    if len(boxes) > MAX_REGIONS:
+        # Keep the largest regions and fold the rest into one
+        boxes = boxes[:MAX_REGIONS - 1] + [_union(boxes[MAX_REGIONS - 1:])]
+
+    # Scale tile boxes back to full-resolution pixels, with padding
+    scale_x = current.width / len(grid[0])
+    scale_y = current.height / len(grid)
+    padding = round(current.width * REGION_PADDING)
+    regions = []
+    for left, top, right, bottom in boxes:
+        regions.append((
+            max(0, round(left * scale_x) - padding),
+            max(0, round(top * scale_y) - padding),
+            min(current.width, round(right * scale_x) + padding),
+            min(current.height, round(bottom * scale_y) + padding)
+        ))
+
+    return {'regions': regions, 'changed_fraction': changed_fraction, 'size': current.size}
+
+def crop_regions(image_data, regions, size=None):
+    """
+    Crop regions out of an image as PNG bytes.
+
+    Args:
+        image_data (bytes): Source image.
+        regions (list): (left, top, right, bottom) boxes.
+        size (tuple): Size the boxes refer to; the image is scaled to it first if it differs.
+
+    Returns:
+        list: PNG bytes for each region.
+    """
+    image = _load(image_data)
+    if size and image.size != tuple(size):
+        image = image.resize(size, Image.BILINEAR)
+
+    crops = []
+    for box in regions:
+        output = io.BytesIO()
+        image.crop(box).save(output, format='PNG')
+        crops.append(output.getvalue())
+    return crops
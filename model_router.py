@@ -0,0 +1,132 @@
+# model_router.py
+import os
+import json
+import threading
+import time
+import logging
+from resilience import get_breaker
+
+logger = logging.getLogger(__name__)
+
+# Primary model first, then fallbacks. Override with a JSON object in MODEL_ROUTES.
+DEFAULT_ROUTES = {
+    'free': {
+        'latency_target': 20.0,
+        'models': [
+            {'model': 'gpt-4o-mini', 'max_tokens': 1500, 'temperature': 0.7},
+            {'model': 'gpt-4o', 'max_tokens': 1500, 'temperature': 0.7}
+        ]
+    },
+    'supporter': {
+        'latency_target': 60.0,
+        'models': [
+            {'model': 'gpt-4', 'max_tokens': 4000, 'temperature': 0.7},
+            {'model': 'gpt-4o', 'max_tokens': 4000, 'temperature': 0.7},
+            {'model': 'gpt-4o-mini', 'max_tokens': 4000, 'temperature': 0.7}
+        ]
+    },
+    # Delta reviews of revised designs send image crops, so only vision models qualify
+    'revision': {
+        'latency_target': 20.0,
+        'models': [
+            {'model': 'gpt-4o', 'max_tokens': 1500, 'temperature': 0.5},
+            {'model': 'gpt-4o-mini', 'max_tokens': 1500, 'temperature': 0.5}
+        ]
+    }
+}
+
+def load_routes():
+    """Routing table from MODEL_ROUTES, falling back to DEFAULT_ROUTES"""
+    raw = os.environ.get('MODEL_ROUTES')
+    if not raw:
+        return DEFAULT_ROUTES
+    try:
+        return json.loads(raw)
+    except ValueError as e:
+        logger.error(f"Invalid MODEL_ROUTES, using defaults: {e}")
+        return DEFAULT_ROUTES
+
+def model_breaker(model):
+    """Circuit breaker for a single model"""
+    return get_breaker(f'openai:{model}')
+
+class ModelRouter:
+    """Orders a tier's models by observed health and latency"""
+
+    def __init__(self, routes=None, smoothing=0.2, error_rate_threshold=0.5, error_half_life=60.0,
+                 latency_ttl=300.0):
+        self.routes = routes or load_routes()
+        self.smoothing = smoothing
+        self.error_rate_threshold = error_rate_threshold
+        # Demoted models are rarely called, so their error rate decays with time instead
+        self.error_half_life = error_half_life
+        # Latency observed longer ago than this is ignored so a slow model gets re-measured
+        self.latency_ttl = latency_ttl
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, model, latency, success):
+        """Fold one call into the model's moving averages"""
+        with self._lock:
+            stats = self._stats.setdefault(model, {
+                'calls': 0,
+                'errors': 0,
+                'latency_ewma': None,
+                'error_rate_ewma': 0.0,
+                'last_call_at': None
+            })
+            stats['calls'] += 1
+            stats['last_call_at'] = time.time()
+            if not success:
+                stats['errors'] += 1
+            # Failed calls often return early, so only successes shape the latency estimate
+            if success:
+                if stats['latency_ewma'] is None:
+                    stats['latency_ewma'] = latency
+                else:
+                    stats['latency_ewma'] += self.smoothing * (latency - stats['latency_ewma'])
+            stats['error_rate_ewma'] += self.smoothing * ((0.0 if success else 1.0) - stats['error_rate_ewma'])
+
+    def plan(self, tier, deadline=None):
+        """
+        Candidate routes for a tier, best first.
+
+        Models with an open circuit go last, then models with a high recent error
+        rate, then models whose observed latency exceeds the tier's target or the
+        time left in the request. Ties keep the routing table order.
+
+        Args:
+            tier (str): 'free', 'supporter' or 'revision'.
+            deadline (Deadline): Request budget, if any.
+
+        Returns:
+            list: Route dicts with 'model', 'max_tokens' and 'temperature'.
+        """
+        route = self.routes[tier]
+        latency_limit = route.get('latency_target') or float('inf')
+        if deadline:
+            latency_limit = min(latency_limit, deadline.remaining())
+
+        with self._lock:
+            stats = {model: dict(values) for model, values in self._stats.items()}
+        now = time.time()
+
+        def rank(item):
+            index, candidate = item
+            model_stats = stats.get(candidate['model'], {})
+            latency = model_stats.get('latency_ewma')
+            error_rate = model_stats.get('error_rate_ewma', 0.0)
+            age = now - model_stats['last_call_at'] if model_stats.get('last_call_at') else 0.0
+            error_rate *= 0.5 ** (age / self.error_half_life)
+            return (
+                model_breaker(candidate['model']).is_open(),
+                error_rate > self.error_rate_threshold,
+                latency is not None and age < self.latency_ttl and latency > latency_limit,
+                index
+            )
+
+        return [candidate for _, candidate in sorted(enumerate(route['models']), key=rank)]
+
+    def snapshot(self):
+        with self._lock:
+            return {model: dict(values) for model, values in self._stats.items()}
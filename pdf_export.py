@@ -0,0 +1,178 @@
+# pdf_export.py
+import os
+import hashlib
+import threading
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from xml.sax.saxutils import escape
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.lib.units import mm
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
+from upload_store import evict_files
+
+logger = logging.getLogger(__name__)
+
+# Bump when the layout changes so stale renders are not served from the cache
+RENDER_VERSION = '1'
+
+def content_hash(review):
+    """Hash everything that affects the rendered PDF"""
+    digest = hashlib.sha256()
+    digest.update(RENDER_VERSION.encode('utf-8'))
+    digest.update(b'\0premium' if review.get('is_premium') else b'\0free')
+    digest.update(b'\0')
+    digest.update(review['review_content'].encode('utf-8'))
+    return digest.hexdigest()
+
+def render_review_pdf(review_content, is_premium, path):
+    """
+    Render cleaned review content to a PDF file.
+
+    Args:
+        review_content (str): Review text with '# ' section headers and '• ' bullets.
+        is_premium (bool): Whether the review was a premium analysis.
+        path (str): Destination file path.
+    """
+    styles = getSampleStyleSheet()
+    bullet_style = ParagraphStyle('ReviewBullet', parent=styles['BodyText'], leftIndent=6 * mm, bulletIndent=2 * mm)
+
+    title = 'Premium Design Review' if is_premium else 'Design Review'
+    story = [Paragraph(title, styles['Title']), Spacer(1, 4 * mm)]
+
+    for line in review_content.split('\n'):
+        stripped = line.strip()
+        if not stripped:
+            continue
+        if stripped.startswith('# '):
+            story.append(Paragraph(escape(stripped[2:]), styles['Heading2']))
+        elif stripped.startswith('• '):
+            story.append(Paragraph(escape(stripped[2:]), bullet_style, bulletText='•'))
+        else:
+            story.append(Paragraph(escape(stripped), styles['BodyText']))
+
+    doc = SimpleDocTemplate(
+        path,
+        pagesize=A4,
+        title=title,
+        leftMargin=18 * mm,
+        rightMargin=18 * mm,
+        topMargin=18 * mm,
+        bottomMargin=18 * mm
+    )
+    doc.build(story)
+
+class PDFExporter:
+    """Renders review PDFs in a background worker pool, cached on disk by content hash"""
+
+    def __init__(self, cache_dir=None, max_workers=None, cache_ttl=None, cache_disk_budget=None):
+        self.cache_dir = cache_dir or os.environ.get('PDF_CACHE_DIR', 'exports')
+        self.max_workers = max_workers or int(os.environ.get('PDF_EXPORT_WORKERS', 2))
+        # Renders are kept for cache_ttl after last download and within cache_disk_budget
+        self.cache_ttl = cache_ttl or int(os.environ.get('PDF_CACHE_TTL', 7 * 24 * 60 * 60))
+        self.cache_disk_budget = cache_disk_budget or int(
+            os.environ.get('PDF_CACHE_DISK_BUDGET', 256 * 1024 * 1024)
+        )
+        # Failed renders are reported to the next poll within this many seconds
+        self.failure_ttl = 60
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._executor = None
+        self._pending = {}
+        self._failures = {}
+        self._lock = threading.RLock()
+        self._last_cleanup = 0.0
+
+    def _get_executor(self):
+        # Created lazily so a forked worker never inherits a pool without threads
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='pdf-export')
+        return self._executor
+
+    def cache_path(self, digest):
+        return os.path.join(self.cache_dir, f'{digest}.pdf')
+
+    def _render(self, review_content, is_premium, digest):
+        path = self.cache_path(digest)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            render_review_pdf(review_content, is_premium, tmp_path)
+            # Atomic rename so readers never see a partially written file
+            os.replace(tmp_path, path)
+            logger.debug(f"Rendered PDF {digest}")
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.cleanup()
+        return path
+
+    def cleanup(self, force=False):
+        """Remove expired renders and evict the oldest ones while over the disk budget"""
+        now = time.time()
+        if not force and now - self._last_cleanup < 30:
+            return
+        self._last_cleanup = now
+
+        removed = evict_files(self.cache_dir, self.cache_ttl, self.cache_disk_budget)
+        if removed:
+            logger.debug(f"Evicted {len(removed)} PDF exports")
+
+    def _forget(self, digest, future):
+        # Successful renders are served from disk; failures are kept briefly so a poll can report them
+        error = future.exception()
+        if error is not None:
+            logger.error(f"PDF render failed for {digest}: {error}")
+        with self._lock:
+            now = time.monotonic()
+            for failed_digest, failed_at in list(self._failures.items()):
+                if now - failed_at >= self.failure_ttl:
+                    del self._failures[failed_digest]
+            # Not pending any more means a poll has already seen the outcome
+            if self._pending.get(digest) is future:
+                del self._pending[digest]
+                if error is not None:
+                    self._failures[digest] = now
+
+    def get_or_schedule(self, review):
+        """
+        Return the cached PDF for a review, scheduling a render if there is none.
+
+        Args:
+            review (dict): Stored review with 'review_content' and 'is_premium'.
+
+        Returns:
+            tuple: (status, path, digest) where status is 'ready', 'rendering' or 'failed'.
+        """
+        digest = content_hash(review)
+        path = self.cache_path(digest)
+
+        try:
+            # Downloads keep a render from expiring
+            os.utime(path)
+            return 'ready', path, digest
+        except FileNotFoundError:
+            pass
+
+        with self._lock:
+            future = self._pending.get(digest)
+
+            if future is not None and future.done():
+                # Finished, but the done-callback has not run yet
+                del self._pending[digest]
+                if future.exception() is None:
+                    return 'ready', future.result(), digest
+                return 'failed', None, digest
+
+            # Report a failure once; the next request retries the render
+            failed_at = self._failures.pop(digest, None)
+            if future is None and failed_at is not None and time.monotonic() - failed_at < self.failure_ttl:
+                return 'failed', None, digest
+
+            if future is None:
+                future = self._get_executor().submit(
+                    self._render, review['review_content'], review.get('is_premium', False), digest
+                )
+                self._pending[digest] = future
+                future.add_done_callback(lambda done: self._forget(digest, done))
+
+        return 'rendering', None, digest
@@ -0,0 +1,177 @@
+# quota.py
+import os
+import secrets
+import sqlite3
+import threading
+import time
+import logging
+from contextlib import contextmanager
+from datetime import datetime, timezone, timedelta
+
+logger = logging.getLogger(__name__)
+
+class QuotaEngine:
+    """
+    Daily review quota with reservations.
+
+    A unit is reserved when a review starts, committed when it succeeds and
+    refunded when it fails, so only successful work counts against the
+    allowance. Reservations left behind by a crashed worker stop counting after
+    reservation_ttl seconds.
+
+    A review can be charged to several identities at once (e.g. an email and
+    the client address), each with its own limit; it is allowed only if every
+    one of them has quota left.
+    """
+
+    def __init__(self, path=None, reservation_ttl=None):
+        self.path = path or os.environ.get('QUOTA_STORE_PATH', 'quota.db')
+        self.reservation_ttl = reservation_ttl or float(os.environ.get('QUOTA_RESERVATION_TTL', 300))
+        self._lock = threading.Lock()
+        self._init_db()
+
+    @contextmanager
+    def _connection(self):
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _init_db(self):
+        with self._connection() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS quota_usage (
+                    identity TEXT NOT NULL,
+                    window TEXT NOT NULL,
+                    used INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (identity, window)
+                )
+            """)
+            # Reservations are short-lived, so an older single-identity table is simply replaced
+            columns = {row['name']: row['pk'] for row in conn.execute('PRAGMA table_info(quota_reservations)')}
+            if columns and not columns.get('identity'):
+                conn.execute('DROP TABLE quota_reservations')
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS quota_reservations (
+                    id TEXT NOT NULL,
+                    identity TEXT NOT NULL,
+                    window TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    PRIMARY KEY (id, identity)
+                )
+            """)
+
+    def _window(self):
+        """Current UTC day and the timestamp it resets at"""
+        now = datetime.now(timezone.utc)
+        reset = datetime(now.year, now.month, now.day, tzinfo=timezone.utc) + timedelta(days=1)
+        return now.strftime('%Y-%m-%d'), int(reset.timestamp())
+
+    def _counts(self, conn, identity, window):
+        row = conn.execute(
+            'SELECT used FROM quota_usage WHERE identity = ? AND window = ?',
+            (identity, window)
+        ).fetchone()
+        reserved = conn.execute(
+            'SELECT COUNT(*) FROM quota_reservations WHERE identity = ? AND window = ? AND created_at > ?',
+            (identity, window, time.time() - self.reservation_ttl)
+        ).fetchone()[0]
+        return (row['used'] if row else 0), reserved
+
+    def _status(self, limit, used, reserved, reset):
+        return {
+            'limit': limit,
+            'used': used,
+            'reserved': reserved,
+            'remaining': max(0, limit - used - reserved),
+            'reset': reset
+        }
+
+    def _combined_status(self, conn, limits, window, reset):
+        """Status of the most constrained identity"""
+        statuses = [
+            dict(self._status(limit, *self._counts(conn, identity, window), reset), identity=identity)
+            for identity, limit in limits.items()
+        ]
+        # Earlier identities win ties, so callers list the one users know first
+        return min(statuses, key=lambda status: status['remaining'])
+
+    def status(self, limits):
+        """
+        Quota status across identities.
+
+        Args:
+            limits (dict): Units allowed per day, by quota key, e.g.
+                {'email:user@example.com': 5, 'ip:203.0.113.7': 15}.
+
+        Returns:
+            dict: 'identity' with the least quota left, and its 'limit', 'used',
+                'reserved', 'remaining' and 'reset' (unix timestamp).
+        """
+        window, reset = self._window()
+        with self._connection() as conn:
+            return self._combined_status(conn, limits, window, reset)
+
+    def reserve(self, limits):
+        """
+        Reserve one unit of quota from every identity in limits.
+
+        Args:
+            limits (dict): Units allowed per day, by quota key.
+
+        Returns:
+            tuple: (reservation id or None if any identity is exhausted, status dict).
+        """
+        window, reset = self._window()
+        with self._lock, self._connection() as conn:
+            # Take the write lock up front so concurrent workers cannot both pass the check
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute(
+                'DELETE FROM quota_reservations WHERE created_at <= ?',
+                (time.time() - self.reservation_ttl,)
+            )
+            status = self._combined_status(conn, limits, window, reset)
+            if status['remaining'] <= 0:
+                return None, status
+
+            reservation_id = secrets.token_hex(8)
+            now = time.time()
+            conn.executemany(
+                'INSERT INTO quota_reservations (id, identity, window, created_at) VALUES (?, ?, ?, ?)',
+                [(reservation_id, identity, window, now) for identity in limits]
+            )
+            return reservation_id, self._combined_status(conn, limits, window, reset)
+
+    def _settle(self, reservation_id, limits, consume):
+        window, reset = self._window()
+        with self._lock, self._connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            rows = conn.execute(
+                'SELECT identity, window FROM quota_reservations WHERE id = ?',
+                (reservation_id,)
+            ).fetchall()
+            if not rows:
+                logger.warning(f"Quota reservation {reservation_id} not found or expired")
+                return None
+
+            conn.execute('DELETE FROM quota_reservations WHERE id = ?', (reservation_id,))
+            if consume:
+                # Charged to the window the work started in
+                conn.executemany("""
+                    INSERT INTO quota_usage (identity, window, used) VALUES (?, ?, 1)
+                    ON CONFLICT (identity, window) DO UPDATE SET used = used + 1
+                """, [(row['identity'], row['window']) for row in rows])
+
+            return self._combined_status(conn, limits, window, reset)
+
+    def commit(self, reservation_id, limits):
+        """Charge a reserved unit for successful work; returns the updated status"""
+        return self._settle(reservation_id, limits, consume=True)
+
+    def refund(self, reservation_id, limits):
+        """Release a reserved unit without charging it; returns the updated status"""
+        return self._settle(reservation_id, limits, consume=False)
@@ -0,0 +1,207 @@
+# resilience.py
+import os
+import re
+import time
+import threading
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+logger = logging.getLogger(__name__)
+
+class DeadlineExceeded(Exception):
+    """Raised when a request budget has no time left for another upstream call"""
+
+class CircuitOpenError(Exception):
+    """Raised when a circuit breaker is rejecting calls to an unhealthy upstream"""
+
+class Deadline:
+    """Time budget for a request, used to derive per-call upstream timeouts"""
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.expires_at = time.monotonic() + budget
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def timeout(self, cap=None, minimum=0.5):
+        """
+        Timeout for the next upstream call.
+
+        Args:
+            cap (float): Upper bound for this call, regardless of the remaining budget.
+            minimum (float): Smallest timeout worth attempting a call with.
+
+        Returns:
+            float: Seconds the call may take.
+        """
+        remaining = self.remaining()
+        if remaining < minimum:
+            raise DeadlineExceeded(f"Request budget of {self.budget}s exhausted")
+        return min(remaining, cap) if cap else remaining
+
+class CircuitBreaker:
+    """
+    Fails fast once an upstream keeps failing, then probes it again after a cool-down.
+
+    States: 'closed' (calls pass), 'open' (calls rejected) and 'half_open'
+    (a single probe call is let through to test recovery). A probe that never
+    reports back is given up on after probe_timeout seconds.
+    """
+
+    def __init__(self, name, failure_threshold=5, recovery_timeout=30.0, probe_timeout=60.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.probe_timeout = probe_timeout
+        self.state = 'closed'
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self._probe_started_at = 0.0
+        self._lock = threading.Lock()
+        self.stats = {
+            'calls': 0,
+            'successes': 0,
+            'failures': 0,
+            'timeouts': 0,
+            'rejected': 0
+        }
+        self.transitions = deque(maxlen=50)
+
+    def _transition(self, state):
+        if state == self.state:
+            return
+        logger.warning(f"Circuit '{self.name}' {self.state} -> {state}")
+        self.transitions.append({'from': self.state, 'to': state, 'at': time.time()})
+        self.state = state
+
+    def allow(self):
+        """Check whether a call may proceed, counting it as rejected otherwise"""
+        with self._lock:
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.recovery_timeout:
+                self._transition('half_open')
+                self._probe_in_flight = False
+
+            if (self.state == 'half_open' and self._probe_in_flight
+                    and time.monotonic() - self._probe_started_at >= self.probe_timeout):
+                logger.warning(f"Circuit '{self.name}' probe never reported back; allowing another")
+                self._probe_in_flight = False
+
+            if self.state == 'closed' or (self.state == 'half_open' and not self._probe_in_flight):
+                if self.state == 'half_open':
+                    self._probe_in_flight = True
+                    self._probe_started_at = time.monotonic()
+                self.stats['calls'] += 1
+                return True
+
+            self.stats['rejected'] += 1
+            return False
+
+    def is_open(self):
+        """True while calls are being rejected and the cool-down has not elapsed"""
+        with self._lock:
+            return self.state == 'open' and time.monotonic() - self.opened_at < self.recovery_timeout
+
+    def record_success(self):
+        with self._lock:
+            self.stats['successes'] += 1
+            self.consecutive_failures = 0
+            self._probe_in_flight = False
+            self._transition('closed')
+
+    def record_failure(self, timeout=False):
+        with self._lock:
+            self.stats['failures'] += 1
+            if timeout:
+                self.stats['timeouts'] += 1
+            self.consecutive_failures += 1
+            self._probe_in_flight = False
+            if self.state == 'half_open' or self.consecutive_failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                self._transition('open')
+
+    def release(self):
+        """Return a probe slot for a call that ended without telling us anything about health"""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'state': self.state,
+                'consecutive_failures': self.consecutive_failures,
+                'failure_threshold': self.failure_threshold,
+                'recovery_timeout': self.recovery_timeout,
+                'probe_timeout': self.probe_timeout,
+                'stats': dict(self.stats),
+                'transitions': list(self.transitions)
+            }
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+def get_breaker(name):
+    """Get the shared circuit breaker for an upstream, configured from the environment"""
+    with _breakers_lock:
+        if name not in _breakers:
+            prefix = 'CIRCUIT_' + re.sub(r'[^A-Z0-9]+', '_', name.upper())
+            _breakers[name] = CircuitBreaker(
+                name,
+                failure_threshold=int(os.environ.get(f'{prefix}_FAILURE_THRESHOLD', 5)),
+                recovery_timeout=float(os.environ.get(f'{prefix}_RECOVERY_TIMEOUT', 30)),
+                probe_timeout=float(os.environ.get(f'{prefix}_PROBE_TIMEOUT', 60))
+            )
+        return _breakers[name]
+
+def breaker_snapshots():
+    """State, counters and recent transitions of every circuit breaker"""
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return {breaker.name: breaker.snapshot() for breaker in breakers}
+
+_hedge_executor = None
+_hedge_lock = threading.Lock()
+
+def _get_hedge_executor():
+    global _hedge_executor
+    with _hedge_lock:
+        # Created lazily so a forked worker never inherits a pool without threads
+        if _hedge_executor is None:
+            _hedge_executor = ThreadPoolExecutor(
+                max_workers=int(os.environ.get('HEDGE_WORKERS', 8)),
+                thread_name_prefix='hedge'
+            )
+        return _hedge_executor
+
+def hedged_call(func, hedge_after, max_attempts=2):
+    """
+    Call func, starting a duplicate attempt if the first has not finished after hedge_after seconds.
+
+    The first successful result wins; losing attempts finish in the background.
+    Raises the last error if every attempt fails.
+    """
+    executor = _get_hedge_executor()
+    pending = {executor.submit(func)}
+    attempts = 1
+    last_error = None
+
+    while pending:
+        timeout = hedge_after if attempts < max_attempts else None
+        done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+
+        for future in done:
+            error = future.exception()
+            if error is None:
+                if attempts > 1:
+                    logger.debug(f"Hedged call completed after {attempts} attempts")
+                return future.result()
+            last_error = error
+
+        # Hedge on a slow attempt, or retry straight away after a fast failure
+        if attempts < max_attempts and (not done or not pending):
+            pending.add(executor.submit(func))
+            attempts += 1
+
+    raise last_error
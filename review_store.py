@@ -0,0 +1,156 @@
+# review_store.py
+import os
+import secrets
+import sqlite3
+import threading
+import time
+import logging
+from contextlib import contextmanager
+from upload_store import evict_files
+
+logger = logging.getLogger(__name__)
+
+class ReviewStore:
+    """Persistent store of generated reviews so they can be exported and shared by id"""
+
+    def __init__(self, path=None, image_dir=None, image_ttl=None, image_disk_budget=None):
+        self.path = path or os.environ.get('REVIEW_STORE_PATH', 'reviews.db')
+        # Reviewed images, content-addressed, so revisions can be diffed against them.
+        # Kept for image_ttl after last use and within image_disk_budget; a revision
+        # whose base image is gone gets a full review instead.
+        self.image_dir = image_dir or os.environ.get('REVIEW_IMAGE_DIR', 'review_images')
+        self.image_ttl = image_ttl or int(os.environ.get('REVIEW_IMAGE_TTL', 7 * 24 * 60 * 60))
+        self.image_disk_budget = image_disk_budget or int(
+            os.environ.get('REVIEW_IMAGE_DISK_BUDGET', 1024 * 1024 * 1024)
+        )
+        os.makedirs(self.image_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._last_cleanup = 0.0
+        self._init_db()
+
+    @contextmanager
+    def _connection(self):
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _init_db(self):
+        with self._connection() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS reviews (
+                    id TEXT PRIMARY KEY,
+                    review_content TEXT NOT NULL,
+                    is_premium INTEGER NOT NULL,
+                    context TEXT,
+                    created_at REAL NOT NULL
+                )
+            """)
+            self._ensure_column(conn, 'model', 'TEXT')
+            self._ensure_column(conn, 'cache_key', 'TEXT')
+            self._ensure_column(conn, 'image_hash', 'TEXT')
+            self._ensure_column(conn, 'previous_review_id', 'TEXT')
+            conn.execute('CREATE INDEX IF NOT EXISTS reviews_cache_key ON reviews (cache_key, created_at)')
+
+    def _ensure_column(self, conn, name, definition):
+        # Columns added after the table was first created
+        columns = {row['name'] for row in conn.execute('PRAGMA table_info(reviews)')}
+        if name not in columns:
+            conn.execute(f'ALTER TABLE reviews ADD COLUMN {name} {definition}')
+
+    def save(self, review, context='', cache_key=None, image_hash=None, previous_review_id=None):
+        """
+        Persist a successful review.
+
+        Args:
+            review (dict): Review as returned by generate_design_review.
+            context (str): Context the user supplied with the design.
+            cache_key (str): Key identical requests can find this review by.
+            image_hash (str): SHA-256 of the reviewed image, saved with save_image.
+            previous_review_id (str): Review this one is a revision of.
+
+        Returns:
+            str: Unguessable review id, safe to use in shareable links.
+        """
+        review_id = secrets.token_urlsafe(16)
+        with self._lock, self._connection() as conn:
+            conn.execute(
+                'INSERT INTO reviews (id, review_content, is_premium, context, model, cache_key, '
+                'image_hash, previous_review_id, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (review_id, review['review_content'], int(bool(review.get('is_premium'))), context,
+                 review.get('model'), cache_key, image_hash, previous_review_id, time.time())
+            )
+        logger.debug(f"Saved review {review_id}")
+        return review_id
+
+    def get(self, review_id):
+        """Fetch a stored review by id, or None if it does not exist"""
+        with self._connection() as conn:
+            row = conn.execute(
+                'SELECT id, review_content, is_premium, context, model, image_hash, previous_review_id, created_at '
+                'FROM reviews WHERE id = ?',
+                (review_id,)
+            ).fetchone()
+
+        if not row:
+            return None
+
+        review = dict(row)
+        review['is_premium'] = bool(review['is_premium'])
+        return review
+
+    def find_cached(self, cache_key, max_age):
+        """Most recent review stored under cache_key within max_age seconds, or None"""
+        with self._connection() as conn:
+            row = conn.execute(
+                'SELECT id FROM reviews WHERE cache_key = ? AND created_at > ? ORDER BY created_at DESC LIMIT 1',
+                (cache_key, time.time() - max_age)
+            ).fetchone()
+        return self.get(row['id']) if row else None
+
+    def _image_path(self, image_hash):
+        return os.path.join(self.image_dir, image_hash)
+
+    def save_image(self, image_hash, image_data):
+        """Keep a reviewed image; identical images are stored once"""
+        path = self._image_path(image_hash)
+        if os.path.exists(path):
+            # Reviewed again; refresh its age instead of rewriting it
+            os.utime(path)
+        else:
+            tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(image_data)
+            os.replace(tmp_path, path)
+        self.cleanup_images()
+
+    def load_image(self, image_hash):
+        """Image a review was based on, or None if it was not kept or has expired"""
+        if not image_hash:
+            return None
+        path = self._image_path(image_hash)
+        try:
+            if os.stat(path).st_mtime < time.time() - self.image_ttl:
+                return None
+            with open(path, 'rb') as f:
+                data = f.read()
+            # A design still being iterated on stays available
+            os.utime(path)
+            return data
+        except FileNotFoundError:
+            return None
+
+    def cleanup_images(self, force=False):
+        """Remove expired review images and evict the oldest ones while over the disk budget"""
+        now = time.time()
+        if not force and now - self._last_cleanup < 30:
+            return
+        self._last_cleanup = now
+
+        removed = evict_files(self.image_dir, self.image_ttl, self.image_disk_budget)
+        if removed:
+            logger.debug(f"Evicted {len(removed)} review images")
@@ -20,6 +20,16 @@ document.addEventListener('DOMContentLoaded', function () {
     const contextArea = document.getElementById('context');
     const contextCharCount = document.getElementById('contextCharCount');
     const supporterStatus = document.getElementById('supporterStatus');
+    const imageInput = document.getElementById('image');
+
+    const revisionOption = document.getElementById('revisionOption');
+    const isRevision = document.getElementById('isRevision');
+
+    // Upload started as soon as an image is selected, resolving to an upload token
+    let pendingUpload = null;
+
+    // Most recent review, offered as the base for reviewing a revision
+    let lastReviewId = null;
 
     // Configure marked.js with custom renderer
     if (typeof marked !== 'undefined') {
@@ -203,6 +213,16 @@ document.addEventListener('DOMContentLoaded', function () {
                     reviewContent.insertBefore(premiumBadge, reviewContent.firstChild);
                 }
 
+                // Add PDF export for premium reviews
+                if (reviewData.is_premium && reviewData.review_id) {
+                    const exportBtn = document.createElement('button');
+                    exportBtn.type = 'button';
+                    exportBtn.className = 'btn btn-outline-primary btn-sm mb-3';
+                    exportBtn.innerHTML = '<i class="bi bi-file-earmark-pdf me-1"></i> Export as PDF';
+                    exportBtn.addEventListener('click', () => exportReviewPdf(reviewData.review_id, exportBtn));
+                    reviewContent.insertBefore(exportBtn, reviewContent.firstChild);
+                }
+
                 // Initialize all sections as expanded and attach event listeners
                 const sectionHeaders = document.querySelectorAll('.section-header');
                 sectionHeaders.forEach(header => {
@@ -250,6 +270,36 @@ document.addEventListener('DOMContentLoaded', function () {
         console.log(`Section ${sectionIndex} toggled to ${!isExpanded ? 'expanded' : 'collapsed'}`);
     }
 
+    // Wait for the background PDF render, then download it
+    async function exportReviewPdf(reviewId, button) {
+        const url = `/reviews/${encodeURIComponent(reviewId)}/export.pdf`;
+        button.disabled = true;
+
+        try {
+            for (let attempt = 0; attempt < 30; attempt++) {
+                const response = await fetch(url, { method: 'HEAD', credentials: 'include' });
+
+                if (response.status === 200) {
+                    window.location.href = url;
+                    return;
+                }
+
+                if (response.status !== 202) {
+                    throw new Error('Failed to export review. Please try again.');
+                }
+
+                const retryAfter = parseInt(response.headers.get('Retry-After'), 10) || 2;
+                await new Promise(r => setTimeout(r, retryAfter * 1000));
+            }
+
+            throw new Error('PDF export is taking longer than expected. Please try again.');
+        } catch (err) {
+            showError(err.message || 'Failed to export review.');
+        } finally {
+            button.disabled = false;
+        }
+    }
+
     // Enhanced fetch with retry
     async function fetchWithRetry(url, options, maxRetries = 3) {
         let lastError;
@@ -271,7 +321,9 @@ document.addEventListener('DOMContentLoaded', function () {
                 }
 
                 if (!response.ok) {
-                    throw new Error(data.message || data.error || `HTTP error! status: ${response.status}`);
+                    const error = new Error(data.message || data.error || `HTTP error! status: ${response.status}`);
+                    error.status = response.status;
+                    throw error;
                 }
 
                 return data;
@@ -279,7 +331,8 @@ document.addEventListener('DOMContentLoaded', function () {
                 console.error(`Attempt ${i + 1} failed:`, err);
                 lastError = err;
 
-                if (i === maxRetries - 1) {
+                // Client errors will not change on retry
+                if (i === maxRetries - 1 || (err.status >= 400 && err.status < 500)) {
                     throw err;
                 }
 
@@ -370,6 +423,63 @@ document.addEventListener('DOMContentLoaded', function () {
         });
     }
 
+    // Client-side checks shared by the early upload and form submission
+    function validateImageFile(file) {
+        if (!file) {
+            throw new Error('Please select an image file.');
+        }
+
+        // Validate file size
+        if (file.size > 5 * 1024 * 1024) { // 5MB
+            throw new Error('File size must be less than 5MB.');
+        }
+
+        // Validate file type
+        const validTypes = ['image/jpeg', 'image/jpg', 'image/png'];
+        if (!validTypes.includes(file.type)) {
+            throw new Error('Please upload a JPEG or PNG image.');
+        }
+    }
+
+    // Upload the image while the user is still typing context
+    async function uploadImage(file) {
+        const formData = new FormData();
+        formData.append('image', file);
+
+        const data = await fetchWithRetry('/uploads', {
+            method: 'POST',
+            body: formData
+        });
+
+        console.log('Image uploaded:', data.sha256);
+        return data;
+    }
+
+    if (imageInput) {
+        imageInput.addEventListener('change', function () {
+            pendingUpload = null;
+            const file = this.files[0];
+            if (!file) return;
+
+            try {
+                validateImageFile(file);
+            } catch (err) {
+                showError(err.message);
+                return;
+            }
+
+            const upload = uploadImage(file).then(data => {
+                // Drop the token slightly before it expires so /analyze never sees a stale one
+                setTimeout(() => {
+                    if (pendingUpload === upload) pendingUpload = null;
+                }, Math.max(0, data.expires_in * 1000 - 30000));
+                return data.upload_token;
+            });
+            upload.catch(err => console.warn('Early upload failed, will send file on submit:', err));
+            pendingUpload = upload;
+        });
+    }
+
     // Handle form submission
     if (form) {
         form.addEventListener('submit', async function (e) {
@@ -380,29 +490,27 @@ document.addEventListener('DOMContentLoaded', function () {
                 const file = document.getElementById('image').files[0];
                 console.log('Selected file:', file);
 
-                if (!file) {
-                    throw new Error('Please select an image file.');
-                }
-
-                // Validate file size
-                if (file.size > 5 * 1024 * 1024) { // 5MB
-                    throw new Error('File size must be less than 5MB.');
-                }
-
-                // Validate file type
-                const validTypes = ['image/jpeg', 'image/jpg', 'image/png'];
-                if (!validTypes.includes(file.type)) {
-                    throw new Error('Please upload a JPEG or PNG image.');
-                }
+                validateImageFile(file);
 
                 console.log('Submitting file:', file);
 
                 const formData = new FormData();
-                formData.append('image', file);
+
+                // Use the early upload when it succeeded; otherwise send the file itself
+                const uploadToken = pendingUpload ? await pendingUpload.catch(() => null) : null;
+                if (uploadToken) {
+                    formData.append('upload_token', uploadToken);
+                } else {
+                    formData.append('image', file);
+                }
 
                 const context = document.getElementById('context').value.trim();
                 formData.append('context', context);
 
+                if (lastReviewId && isRevision && isRevision.checked) {
+                    formData.append('previous_review_id', lastReviewId);
+                }
+
                 // Log formData entries for debugging
                 console.log('FormData entries:');
                 for (let pair of formData.entries()) {
@@ -413,10 +521,25 @@ document.addEventListener('DOMContentLoaded', function () {
                 submitBtn.disabled = true;
 
                 console.log('Before fetchWithRetry');
-                const data = await fetchWithRetry('/analyze', {
-                    method: 'POST',
-                    body: formData
-                });
+                let data;
+                try {
+                    data = await fetchWithRetry('/analyze', {
+                        method: 'POST',
+                        body: formData
+                    });
+                } catch (err) {
+                    if (!uploadToken || err.status !== 410) {
+                        throw err;
+                    }
+                    // Early upload was evicted server-side; send the file itself
+                    pendingUpload = null;
+                    formData.delete('upload_token');
+                    formData.append('image', file);
+                    data = await fetchWithRetry('/analyze', {
+                        method: 'POST',
+                        body: formData
+                    });
+                }
                 console.log('After fetchWithRetry');
 
                 console.log('Review data received:', data);
@@ -431,6 +554,11 @@ document.addEventListener('DOMContentLoaded', function () {
 
                 await showResult(data.review);
 
+                if (data.review && data.review.review_id) {
+                    lastReviewId = data.review.review_id;
+                    if (revisionOption) revisionOption.classList.remove('d-none');
+                }
+
                 if (data.rate_info) {
                     updateRateInfo(data.rate_info);
                 }
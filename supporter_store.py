@@ -0,0 +1,249 @@
+# supporter_store.py
+import os
+import sqlite3
+import threading
+import time
+import logging
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+class SupporterStore:
+    """Persistent local index of supporters, kept current by webhooks and reconciliation"""
+
+    def __init__(self, path=None):
+        self.path = path or os.environ.get('SUPPORTER_STORE_PATH', 'supporters.db')
+        self._lock = threading.Lock()
+        self._init_db()
+
+    @contextmanager
+    def _connection(self):
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _init_db(self):
+        with self._connection() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            # One row per (email, kind) so a lapsed subscription never hides a one-time support
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS supporters (
+                    email TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    last_support_date TEXT,
+                    total_support REAL NOT NULL DEFAULT 0,
+                    expires_at REAL,
+                    source TEXT NOT NULL,
+                    event_at REAL NOT NULL DEFAULT 0,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (email, kind)
+                )
+            """)
+            # Webhook deliveries already applied, so redeliveries are not counted twice
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS webhook_events (
+                    event_key TEXT PRIMARY KEY,
+                    received_at REAL NOT NULL
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS sync_state (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                )
+            """)
+
+    def upsert(self, email, kind, last_support_date=None, total_support=0.0,
+               expires_at=None, source='webhook', event_at=None, increment=False):
+        """
+        Insert or update a supporter record.
+
+        Args:
+            email (str): Supporter email address.
+            kind (str): 'subscription' or 'one_time'.
+            last_support_date (str): Date of the most recent support.
+            total_support (float): Support amount, or the amount to add when incrementing.
+            expires_at (float): Unix timestamp the premium tier lapses at, None for no expiry.
+            source (str): 'webhook' or 'reconcile'.
+            event_at (float): Timestamp of the originating event; older events are ignored.
+            increment (bool): Add total_support to the stored total instead of replacing it.
+
+        Returns:
+            bool: True if the record was written, False if it was stale.
+        """
+        email = email.strip().lower()
+        now = time.time()
+        event_at = event_at or now
+
+        with self._lock, self._connection() as conn:
+            row = conn.execute(
+                'SELECT total_support, event_at FROM supporters WHERE email = ? AND kind = ?',
+                (email, kind)
+            ).fetchone()
+
+            if row and row['event_at'] > event_at:
+                logger.debug(f"Ignoring stale {kind} event for {email}")
+                return False
+
+            if increment and row:
+                total_support = row['total_support'] + total_support
+
+            conn.execute("""
+                INSERT INTO supporters
+                    (email, kind, last_support_date, total_support, expires_at, source, event_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (email, kind) DO UPDATE SET
+                    last_support_date = COALESCE(excluded.last_support_date, last_support_date),
+                    total_support = excluded.total_support,
+                    expires_at = excluded.expires_at,
+                    source = excluded.source,
+                    event_at = excluded.event_at,
+                    updated_at = excluded.updated_at
+            """, (email, kind, last_support_date, total_support, expires_at, source, event_at, now))
+
+        return True
+
+    def expire(self, email, kind, expires_at=None, event_at=None):
+        """Mark a supporter record as lapsing at expires_at (defaults to now)"""
+        email = email.strip().lower()
+        now = time.time()
+        expires_at = now if expires_at is None else expires_at
+
+        with self._lock, self._connection() as conn:
+            cursor = conn.execute("""
+                UPDATE supporters
+                SET expires_at = ?, event_at = ?, updated_at = ?
+                WHERE email = ? AND kind = ? AND event_at <= ?
+            """, (expires_at, event_at or now, now, email, kind, event_at or now))
+            return cursor.rowcount > 0
+
+    def refund(self, email, kind, amount, event_at=None):
+        """
+        Subtract a refunded amount from a supporter record.
+
+        Refunds are deltas, so unlike upsert they apply whatever order events
+        arrive in. The record expires once nothing unrefunded is left.
+
+        Returns:
+            bool: True if the record was changed.
+        """
+        email = email.strip().lower()
+        now = time.time()
+        event_at = event_at or now
+
+        with self._lock, self._connection() as conn:
+            row = conn.execute(
+                'SELECT total_support, expires_at, event_at FROM supporters WHERE email = ? AND kind = ?',
+                (email, kind)
+            ).fetchone()
+            if not row:
+                return False
+
+            total_support = max(0.0, row['total_support'] - amount)
+            # Amounts are currency, so anything under a cent counts as fully refunded
+            expires_at = now if total_support < 0.01 else row['expires_at']
+            conn.execute("""
+                UPDATE supporters
+                SET total_support = ?, expires_at = ?, event_at = ?, updated_at = ?
+                WHERE email = ? AND kind = ?
+            """, (total_support, expires_at, max(row['event_at'], event_at), now, email, kind))
+            return True
+
+    def expire_unseen(self, kind, seen_emails, before):
+        """
+        Expire records of a kind missing from a full reconciliation pass.
+
+        Records touched by a webhook after the pass started are left alone.
+
+        Returns:
+            int: Number of records expired.
+        """
+        seen = {email.lower() for email in seen_emails}
+        now = time.time()
+        expired = 0
+
+        with self._lock, self._connection() as conn:
+            rows = conn.execute("""
+                SELECT email FROM supporters
+                WHERE kind = ? AND updated_at < ? AND (expires_at IS NULL OR expires_at > ?)
+            """, (kind, before, now)).fetchall()
+
+            for row in rows:
+                if row['email'] not in seen:
+                    conn.execute(
+                        'UPDATE supporters SET expires_at = ?, updated_at = ? WHERE email = ? AND kind = ?',
+                        (now, now, row['email'], kind)
+                    )
+                    expired += 1
+
+        return expired
+
+    def get_status(self, email):
+        """
+        Look up the supporter status for an email.
+
+        Returns:
+            dict: Supporter status in the same shape as BuyMeACoffeeAPI.get_supporter_status,
+                or None if the email has no active support.
+        """
+        email = email.strip().lower()
+        now = time.time()
+
+        with self._connection() as conn:
+            rows = conn.execute("""
+                SELECT last_support_date, total_support FROM supporters
+                WHERE email = ? AND (expires_at IS NULL OR expires_at > ?)
+            """, (email, now)).fetchall()
+
+        if not rows:
+            return None
+
+        support_dates = [row['last_support_date'] for row in rows if row['last_support_date']]
+        return {
+            'is_supporter': True,
+            'tier': 'premium',
+            'last_support_date': max(support_dates) if support_dates else None,
+            'total_support': sum(row['total_support'] for row in rows)
+        }
+
+    def claim_event(self, event_key):
+        """
+        Record a webhook event as being applied.
+
+        Returns:
+            bool: True if the event is new, False if it was already claimed.
+        """
+        with self._lock, self._connection() as conn:
+            cursor = conn.execute(
+                'INSERT OR IGNORE INTO webhook_events (event_key, received_at) VALUES (?, ?)',
+                (event_key, time.time())
+            )
+            return cursor.rowcount > 0
+
+    def prune_events(self, before):
+        """Forget webhook events received before a timestamp; returns how many were removed"""
+        with self._lock, self._connection() as conn:
+            cursor = conn.execute('DELETE FROM webhook_events WHERE received_at < ?', (before,))
+            return cursor.rowcount
+
+    def release_event(self, event_key):
+        """Forget a claimed event whose handling failed, so a redelivery is applied"""
+        with self._lock, self._connection() as conn:
+            conn.execute('DELETE FROM webhook_events WHERE event_key = ?', (event_key,))
+
+    def get_state(self, key, default=None):
+        with self._connection() as conn:
+            row = conn.execute('SELECT value FROM sync_state WHERE key = ?', (key,)).fetchone()
+        return row['value'] if row else default
+
+    def set_state(self, key, value):
+        with self._lock, self._connection() as conn:
+            conn.execute(
+                'INSERT INTO sync_state (key, value) VALUES (?, ?) '
+                'ON CONFLICT (key) DO UPDATE SET value = excluded.value',
+                (key, str(value))
+            )
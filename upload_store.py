@@ -0,0 +1,176 @@
+# upload_store.py
+import os
+import hashlib
+import hmac
+import threading
+import time
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+def evict_files(directory, ttl, disk_budget):
+    """
+    Remove files older than ttl, then the oldest ones while over disk_budget.
+
+    Args:
+        directory (str): Directory of content-addressed files, aged by mtime.
+        ttl (float): Seconds a file is kept after it was last written or touched.
+        disk_budget (int): Bytes the directory may hold.
+
+    Returns:
+        list: Names of the removed files.
+    """
+    now = time.time()
+    entries = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, name, path))
+
+    entries.sort()
+    total = sum(size for _, size, _, _ in entries)
+    removed = []
+
+    for mtime, size, name, path in entries:
+        # Stale temp files count as expired too
+        if mtime >= now - ttl and total <= disk_budget:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        removed.append(name)
+
+    return removed
+
+class UploadStore:
+    """
+    Short-lived storage for images uploaded ahead of /analyze.
+
+    Images are content-addressed by SHA-256 on disk so every worker process can
+    read them, with a per-process in-memory LRU in front. Tokens are signed and
+    carry their own expiry, so no token state has to be shared between workers.
+    """
+
+    def __init__(self, secret, upload_dir=None, ttl=None, memory_budget=None, disk_budget=None):
+        if not secret:
+            # An empty key would let anyone sign tokens for arbitrary digests
+            raise ValueError("UploadStore needs a secret to sign upload tokens; set FLASK_SECRET_KEY")
+        self.secret = secret.encode('utf-8')
+        self.upload_dir = upload_dir or os.environ.get('UPLOAD_DIR', 'uploads')
+        self.ttl = ttl or int(os.environ.get('UPLOAD_TTL', 15 * 60))
+        self.memory_budget = memory_budget or int(os.environ.get('UPLOAD_MEMORY_BUDGET', 64 * 1024 * 1024))
+        self.disk_budget = disk_budget or int(os.environ.get('UPLOAD_DISK_BUDGET', 512 * 1024 * 1024))
+        os.makedirs(self.upload_dir, exist_ok=True)
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._lock = threading.Lock()
+        self._last_cleanup = 0.0
+
+    def _path(self, digest):
+        return os.path.join(self.upload_dir, digest)
+
+    def _sign(self, payload):
+        return hmac.new(self.secret, payload.encode('utf-8'), hashlib.sha256).hexdigest()[:32]
+
+    def _remember(self, digest, data):
+        with self._lock:
+            if digest in self._memory:
+                self._memory.move_to_end(digest)
+                return
+            self._memory[digest] = data
+            self._memory_size += len(data)
+            while self._memory_size > self.memory_budget and self._memory:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_size -= len(evicted)
+
+    def put(self, image_data):
+        """
+        Store a normalized image.
+
+        Args:
+            image_data (bytes): Normalized image data.
+
+        Returns:
+            dict: 'upload_token', 'sha256' and 'expires_in' (seconds).
+        """
+        digest = hashlib.sha256(image_data).hexdigest()
+        path = self._path(digest)
+
+        if os.path.exists(path):
+            # Same image uploaded again; refresh its age instead of rewriting it
+            os.utime(path)
+        else:
+            tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(image_data)
+            os.replace(tmp_path, path)
+
+        self._remember(digest, image_data)
+        self.cleanup()
+
+        expires_at = int(time.time()) + self.ttl
+        payload = f'{digest}.{expires_at}'
+        return {
+            'upload_token': f'{payload}.{self._sign(payload)}',
+            'sha256': digest,
+            'expires_in': self.ttl
+        }
+
+    def get(self, token):
+        """
+        Resolve an upload token to its image.
+
+        Returns:
+            tuple: (image bytes, sha256 digest), or (None, None) if the token is
+                invalid, expired or its image has been evicted.
+        """
+        try:
+            digest, expires_at, signature = token.split('.')
+            expires_at = int(expires_at)
+        except (AttributeError, ValueError):
+            return None, None
+
+        if not hmac.compare_digest(signature, self._sign(f'{digest}.{expires_at}')):
+            logger.warning("Rejected upload token with invalid signature")
+            return None, None
+
+        if expires_at < time.time():
+            return None, None
+
+        with self._lock:
+            data = self._memory.get(digest)
+            if data is not None:
+                self._memory.move_to_end(digest)
+                return data, digest
+
+        try:
+            with open(self._path(digest), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None, None
+
+        self._remember(digest, data)
+        return data, digest
+
+    def cleanup(self, force=False):
+        """Remove expired uploads and evict the oldest ones while over the disk budget"""
+        now = time.time()
+        if not force and now - self._last_cleanup < 30:
+            return
+        self._last_cleanup = now
+
+        removed = evict_files(self.upload_dir, self.ttl, self.disk_budget)
+        with self._lock:
+            for name in removed:
+                evicted = self._memory.pop(name, None)
+                if evicted is not None:
+                    self._memory_size -= len(evicted)
+
+        if removed:
+            logger.debug(f"Evicted {len(removed)} uploads")
@@ -1,11 +1,16 @@
 # utils.py
 
 import base64
+import io
 import os
 import logging
 import re
-from openai import OpenAI, OpenAIError
+import time
+from openai import OpenAI, OpenAIError, APIConnectionError, APITimeoutError, APIStatusError
 from dotenv import load_dotenv
+from PIL import Image, ImageOps
+from resilience import CircuitOpenError, DeadlineExceeded
+from model_router import ModelRouter, model_breaker
 
 # Load environment variables from .env file
 load_dotenv()
@@ -21,8 +26,63 @@ def validate_api_key():
         raise RuntimeError("OPENAI_API_KEY environment variable is required")
     return api_key
 
-# Initialize OpenAI client with the validated API key
-openai_client = OpenAI(api_key=validate_api_key())
+# Initialize OpenAI client with the validated API key. Retries are disabled so the
+# request deadline and circuit breaker alone decide how long a call may take.
+openai_client = OpenAI(api_key=validate_api_key(), max_retries=0)
+
+# Upper bound for a single completion call, on top of the request budget
+OPENAI_TIMEOUT = float(os.environ.get('OPENAI_TIMEOUT', 90))
+
+# Per-tier primary and fallback models, ordered by observed health and latency
+model_router = ModelRouter()
+
+def warm_up_openai(timeout=5):
+    """Open a pooled connection to the OpenAI API before serving traffic"""
+    try:
+        openai_client.with_options(timeout=timeout).models.list()
+        return True
+    except OpenAIError as e:
+        logger.warning(f"OpenAI warm-up failed: {e}")
+        return False
+
+def create_completion(deadline=None, **kwargs):
+    """
+    Call the chat completions API with a deadline-derived timeout behind the model's circuit breaker.
+
+    Args:
+        deadline (Deadline): Request budget the call must fit in.
+        **kwargs: Arguments for chat.completions.create, including model.
+
+    Returns:
+        The completion response.
+    """
+    timeout = deadline.timeout(cap=OPENAI_TIMEOUT) if deadline else OPENAI_TIMEOUT
+    breaker = model_breaker(kwargs['model'])
+
+    if not breaker.allow():
+        raise CircuitOpenError(f"OpenAI circuit for {kwargs['model']} is open")
+
+    try:
+        response = openai_client.chat.completions.create(timeout=timeout, **kwargs)
+    except APITimeoutError:
+        breaker.record_failure(timeout=True)
+        raise
+    except APIConnectionError:
+        breaker.record_failure()
+        raise
+    except APIStatusError as e:
+        # Only server-side trouble says anything about upstream health
+        if e.status_code >= 500 or e.status_code == 429:
+            breaker.record_failure()
+        else:
+            breaker.release()
+        raise
+    except Exception:
+        breaker.release()
+        raise
+
+    breaker.record_success()
+    return response
 
 def encode_image(image_data):
     """
@@ -42,6 +102,69 @@ def encode_image(image_data):
         logger.error(f"Error encoding image: {e}")
         raise
 
+# Longest side, in pixels, an uploaded design is scaled down to
+MAX_IMAGE_DIMENSION = int(os.environ.get('MAX_IMAGE_DIMENSION', 2048))
+# Largest image, in pixels, decoded at all; small files can declare huge canvases
+MAX_IMAGE_PIXELS = int(os.environ.get('MAX_IMAGE_PIXELS', 40 * 1000 * 1000))
+
+def normalize_image(image_data):
+    """
+    Validate and normalize an uploaded PNG or JPEG image.
+
+    Applies EXIF orientation, scales the image down to MAX_IMAGE_DIMENSION and
+    re-encodes it, which also strips metadata. Images over MAX_IMAGE_PIXELS are
+    rejected from their header, before any pixel data is decoded.
+
+    Args:
+        image_data (bytes): Raw uploaded image data.
+
+    Returns:
+        tuple: (normalized bytes, format) where format is 'PNG' or 'JPEG'.
+
+    Raises:
+        ValueError: If the data is not a valid PNG or JPEG image, or is too large.
+    """
+    try:
+        with Image.open(io.BytesIO(image_data)) as probe:
+            probe.verify()
+
+        # verify() leaves the image unusable, so decode it again
+        image = Image.open(io.BytesIO(image_data))
+        image_format = image.format
+        if image_format not in ('PNG', 'JPEG'):
+            raise ValueError(f"Unsupported image format: {image_format}")
+
+        width, height = image.size
+        if width * height > MAX_IMAGE_PIXELS:
+            raise ValueError(
+                f"Image is too large ({width}x{height}); the limit is {MAX_IMAGE_PIXELS // 1000000} megapixels"
+            )
+
+        if image_format == 'JPEG':
+            # Let the decoder downscale by up to 8x instead of decoding full size
+            image.draft(image.mode, (MAX_IMAGE_DIMENSION, MAX_IMAGE_DIMENSION))
+
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((MAX_IMAGE_DIMENSION, MAX_IMAGE_DIMENSION))
+
+        if image_format == 'JPEG' and image.mode != 'RGB':
+            image = image.convert('RGB')
+
+        output = io.BytesIO()
+        if image_format == 'JPEG':
+            image.save(output, format='JPEG', quality=90)
+        else:
+            image.save(output, format='PNG')
+
+        normalized = output.getvalue()
+        logger.debug(f"Image normalized: {len(image_data)} -> {len(normalized)} bytes, {image.size}")
+        return normalized, image_format
+    except ValueError:
+        raise
+    except Exception as e:
+        logger.error(f"Error normalizing image: {e}")
+        raise ValueError('Invalid or corrupted image file') from e
+
 PROMPTS = {
     'free': """
 You are a design expert providing valuable feedback. Analyze this design using core UX/UI principles.
@@ -312,9 +435,56 @@ Technical Guidelines:
 Context: {context}
 
 Provide specific, actionable insights backed by UX principles and industry standards. Focus on strategic improvements that enhance both user experience and business value. Include technical considerations and implementation guidelines where relevant.
+""",
+
+    'revision': """
+You are a design expert reviewing a new iteration of a design you have already reviewed.
+
+You are NOT shown the whole design. You are shown only the regions that changed, each as a
+BEFORE crop followed by an AFTER crop, numbered in the order listed below.
+
+Changed regions (left, top, right, bottom in pixels of a {width}x{height} design):
+{regions}
+
+Summary of your previous review:
+{previous_review}
+
+Provide a delta review in this exact structure:
+
+# Overview of Changes
+Summarize in 2-3 sentences what changed in each region and the overall direction of the iteration.
+
+# Resolved Issues
+List issues from the previous review that these changes address, and how well they address them.
+
+# New or Remaining Issues
+List problems the changes introduce, and previous issues in the changed regions that remain.
+
+# Suggestions
+Provide 2-4 specific, actionable next steps for the next iteration.
+
+Only comment on the changed regions; assume everything else is unchanged from the previous review.
+
+Context: {context}
 """
 }
 
+SYSTEM_PROMPT = """
+You are a professional design expert providing detailed, constructive feedback.
+
+Important formatting rules:
+1. Use ONLY plain text - no markdown or special formatting
+2. Format sections with '# ' prefix (Example: '# Overview')
+3. Use bullet points with '• ' prefix (NOT with '-' or '*')
+4. Use indentation with spaces for sub-points
+5. Keep paragraphs well-spaced with single blank lines
+6. Do not use any styling characters (*, **, _, __, etc.)
+7. Keep section headers clean without any additional formatting
+
+Your review should be thorough and valuable while maintaining clean, consistent formatting.
+Structure your response exactly according to the sections in the prompt.
+"""
+
 def clean_review_content(content):
     """
     Clean up any markdown or unwanted formatting in the review content.
@@ -355,56 +525,63 @@ def clean_review_content(content):
         logger.error(f"Error cleaning content: {e}")
         return content  # Return original content if cleaning fails
 
-def generate_design_review(base64_image, context, is_supporter=False):
+def complete_with_fallback(tier, messages, deadline=None):
     """
-    Generate a design review based on user tier.
+    Run a completion on the best available model for a tier, falling back down its route.
 
     Args:
-        base64_image (str): Base64-encoded image data.
-        context (str): Additional context provided by the user.
+        tier (str): 'free', 'supporter' or 'revision'.
+        messages (list): Chat messages.
+        deadline (Deadline): Request budget shared by every attempt.
+
+    Returns:
+        tuple: (completion response, name of the model that served it).
+    """
+    last_error = None
+
+    for route in model_router.plan(tier, deadline):
+        model = route['model']
+        started = time.monotonic()
+        try:
+            response = create_completion(
+                deadline=deadline,
+                model=model,
+                messages=messages,
+                max_tokens=route['max_tokens'],
+                temperature=route['temperature']
+            )
+        except CircuitOpenError as e:
+            last_error = e
+            continue
+        except (APIConnectionError, APIStatusError) as e:
+            model_router.record(model, time.monotonic() - started, success=False)
+            # Other client errors are about the request itself; another model will not help
+            if isinstance(e, APIStatusError) and e.status_code < 500 and e.status_code not in (404, 429):
+                raise
+            logger.warning(f"Model {model} failed, trying next fallback: {e}")
+            last_error = e
+            continue
+
+        model_router.record(model, time.monotonic() - started, success=True)
+        return response, model
+
+    raise last_error or CircuitOpenError(f"No model available for tier {tier}")
+
+def run_review(tier, messages, is_supporter, deadline=None):
+    """
+    Run a review completion and shape the result.
+
+    Args:
+        tier (str): Routing tier, see model_router.
+        messages (list): Chat messages.
         is_supporter (bool): Indicates if the user is a supporter.
+        deadline (Deadline): Request budget the upstream calls must fit in.
 
     Returns:
         dict: Contains the review content and status.
     """
     try:
-        logger.debug(f"Generating {'premium' if is_supporter else 'free'} review")
-        
-        system_prompt = """
-You are a professional design expert providing detailed, constructive feedback.
-
-Important formatting rules:
-1. Use ONLY plain text - no markdown or special formatting
-2. Format sections with '# ' prefix (Example: '# Overview')
-3. Use bullet points with '• ' prefix (NOT with '-' or '*')
-4. Use indentation with spaces for sub-points
-5. Keep paragraphs well-spaced with single blank lines
-6. Do not use any styling characters (*, **, _, __, etc.)
-7. Keep section headers clean without any additional formatting
-
-Your review should be thorough and valuable while maintaining clean, consistent formatting.
-Structure your response exactly according to the sections in the prompt.
-"""
-        
-        prompt = PROMPTS['supporter' if is_supporter else 'free'].format(
-            context=context
-        )
-        
-        response = openai_client.chat.completions.create(
-            model="gpt-4",
-            messages=[
-                {
-                    "role": "system",
-                    "content": system_prompt
-                },
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ],
-            max_tokens=4000,
-            temperature=0.7
-        )
+        response, model = complete_with_fallback(tier, messages, deadline=deadline)
         
         review_content = response.choices[0].message.content
         
@@ -418,9 +595,18 @@ Structure your response exactly according to the sections in the prompt.
         return {
             'review_content': cleaned_content,
             'is_premium': is_supporter,
+            'model': model,
             'status': 'success'
         }
         
+    except (CircuitOpenError, DeadlineExceeded) as e:
+        logger.error(f"AI service unavailable: {e}")
+        return {
+            'error': 'Failed to generate review',
+            'message': 'The AI service is temporarily unavailable. Please try again shortly.',
+            'is_premium': is_supporter,
+            'status': 'error'
+        }
     except OpenAIError as e:
         logger.error(f"OpenAI API error: {e}")
         return {
@@ -437,3 +623,121 @@ Structure your response exactly according to the sections in the prompt.
             'is_premium': is_supporter,
             'status': 'error'
         }
+
+def generate_design_review(base64_image, context, is_supporter=False, deadline=None):
+    """
+    Generate a design review based on user tier.
+
+    Args:
+        base64_image (str): Base64-encoded image data.
+        context (str): Additional context provided by the user.
+        is_supporter (bool): Indicates if the user is a supporter.
+        deadline (Deadline): Request budget the upstream call must fit in.
+
+    Returns:
+        dict: Contains the review content and status.
+    """
+    logger.debug(f"Generating {'premium' if is_supporter else 'free'} review")
+
+    tier = 'supporter' if is_supporter else 'free'
+    prompt = PROMPTS[tier].format(
+        context=context
+    )
+
+    return run_review(
+        tier,
+        [
+            {
+                "role": "system",
+                "content": SYSTEM_PROMPT
+            },
+            {
+                "role": "user",
+                "content": prompt
+            }
+        ],
+        is_supporter,
+        deadline=deadline
+    )
+
+def summarize_review(review_content, max_chars=1500):
+    """
+    Condense a previous review for use as context in a revision prompt.
+
+    Keeps every section header and the first few points of each section.
+
+    Args:
+        review_content (str): Cleaned review content.
+        max_chars (int): Upper bound on the summary length.
+
+    Returns:
+        str: The condensed review.
+    """
+    lines = []
+    points_in_section = 0
+    for line in review_content.split('\n'):
+        stripped = line.strip()
+        if not stripped:
+            continue
+        if stripped.startswith('# '):
+            lines.append(stripped)
+            points_in_section = 0
+        elif points_in_section < 3:
+            lines.append(stripped)
+            points_in_section += 1
+
+    summary = '\n'.join(lines)
+    if len(summary) > max_chars:
+        summary = summary[:max_chars].rsplit('\n', 1)[0]
+    return summary
+
+def generate_revision_review(previous_crops, current_crops, regions, size, previous_review, context,
+                             is_supporter=False, deadline=None):
+    """
+    Generate a delta review of a revised design from crops of its changed regions.
+
+    Args:
+        previous_crops (list): PNG bytes of each changed region in the previous design.
+        current_crops (list): PNG bytes of each changed region in the revision.
+        regions (list): (left, top, right, bottom) box of each changed region.
+        size (tuple): (width, height) of the revised design.
+        previous_review (str): Content of the review of the previous design.
+        context (str): Additional context provided by the user.
+        is_supporter (bool): Indicates if the user is a supporter.
+        deadline (Deadline): Request budget the upstream call must fit in.
+
+    Returns:
+        dict: Contains the review content and status.
+    """
+    logger.debug(f"Generating revision review for {len(regions)} changed regions")
+
+    prompt = PROMPTS['revision'].format(
+        width=size[0],
+        height=size[1],
+        regions='\n'.join(f"{index}. {box}" for index, box in enumerate(regions, start=1)),
+        previous_review=summarize_review(previous_review),
+        context=context
+    )
+
+    content = [{"type": "text", "text": prompt}]
+    for index, (before, after) in enumerate(zip(previous_crops, current_crops), start=1):
+        content.append({"type": "text", "text": f"Region {index} BEFORE:"})
+        content.append({"type": "image_url", "image_url": {"url": f"data:image/png;base64,{encode_image(before)}"}})
+        content.append({"type": "text", "text": f"Region {index} AFTER:"})
+        content.append({"type": "image_url", "image_url": {"url": f"data:image/png;base64,{encode_image(after)}"}})
+
+    return run_review(
+        'revision',
+        [
+            {
+                "role": "system",
+                "content": SYSTEM_PROMPT
+            },
+            {
+                "role": "user",
+                "content": content
+            }
+        ],
+        is_supporter,
+        deadline=deadline
+    )